@@ -1,15 +1,28 @@
+import datetime
+import io
+import os
 import re
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 
 from playhouse.test_utils import test_database
 from peewee import *
 
+import exports
+import ingest
+import migrations
 import sos_tracker
-from models import User, Team, Coordinate, FTSCoord
+import upload_worker
+import weather_update
+from models import User, Team, CellForecast, Coordinate, CoordinateFTS, CoordinateNameFTS, CoordinateRTree, DataVersion, IdentityCache, PointCount, SlugAllocator, UploadJob, Visit, Weather, WeatherDay
+from pagination import KeysetPagination, decode_cursor, encode_cursor
+from searchcache import SearchCache
 
 TEST_DB = SqliteDatabase(':memory:')
 TEST_DB.connect()
-TEST_DB.create_tables([Team, User, Coordinate, FTSCoord], safe=True)
+TEST_DB.create_tables([Team, User, Coordinate, CoordinateFTS], safe=True)
 
 LOGIN_USER_DATA = {
 	'email': 'test_0@example.com',
@@ -70,8 +83,36 @@ class UserModelTestCase(unittest.TestCase):
 					team='Team Tester'
 				)
 
+	def test_identity_cache(self):
+		with test_database(TEST_DB, (Team, User,)):
+			self.create_users()
+			cache = IdentityCache(ttl=60)
+			user = User.get(User.username == 'test_user0')
+			self.assertEqual(cache.get(user.id).team.name, 'Team Tester')
+			User.update(email='stale@example.com').where(User.id == user.id).execute()
+			self.assertEqual(cache.get(user.id).email, 'test_0@example.com')
+			cache.invalidate(user.id)
+			self.assertEqual(cache.get(user.id).email, 'stale@example.com')
+			with self.assertRaises(User.DoesNotExist):
+				cache.get(user.id + 100)
+
 
 class CoordModelTestCase(unittest.TestCase):
+	@staticmethod
+	def create_points(*names, **fields):
+		user = fields.pop('user', None) or User.select().get()
+		points = []
+		for name in names:
+			point = {
+				'latitude': 37.301507,
+				'longitude': -113.961580,
+				'notes': 'This is a test. This is only a test.',
+				'published': True
+			}
+			point.update(fields)
+			points.append(Coordinate.create(user=user, name=name, **point))
+		return points
+
 	def test_coord_creation(self):
 		with test_database(TEST_DB, (Team, User, Coordinate)):
 			UserModelTestCase.create_users()
@@ -93,6 +134,320 @@ class CoordModelTestCase(unittest.TestCase):
 			)
 			self.assertEqual(point.user, user)
 
+	def test_duplicate_name_slugs(self):
+		with test_database(TEST_DB, (Team, User, Coordinate)):
+			UserModelTestCase.create_users()
+			self.create_points('Test Coord', 'Test Coord', 'Test Coord')
+			self.assertEqual(
+				[point.slug for point in Coordinate.select().order_by(Coordinate.id)],
+				['test-coord', 'test-coord-2', 'test-coord-3']
+			)
+			self.assertEqual(
+				SlugAllocator().allocate(['Test Coord', 'Test Coord', 'Other']),
+				['test-coord-4', 'test-coord-5', 'other']
+			)
+
+	def test_team_triggers(self):
+		with test_database(TEST_DB, (Team, User, Coordinate)):
+			UserModelTestCase.create_users()
+			Team.create_team(name='Other Team', institution='University of Utah', code='Testing456')
+			first, second = User.select().order_by(User.id)
+			other = Team.get(Team.name == 'Other Team')
+			point = self.create_points('Test Coord', user=first, published=False)[0]
+			self.assertEqual(Coordinate.get_by_id(point.id).team_id, first.team_id)
+			first.team = other
+			first.save()
+			self.assertEqual(Coordinate.get_by_id(point.id).team_id, other.id)
+			Coordinate.update(user=second).where(Coordinate.id == point.id).execute()
+			self.assertEqual(Coordinate.get_by_id(point.id).team_id, second.team_id)
+
+	def test_add_coordinate_team(self):
+		database = SqliteDatabase(':memory:')
+		database.execute_sql('CREATE TABLE "user" (id INTEGER PRIMARY KEY, team_id INTEGER)')
+		database.execute_sql('CREATE TABLE coordinate (id INTEGER PRIMARY KEY, user_id INTEGER, name TEXT)')
+		database.execute_sql('INSERT INTO "user" VALUES (1, 7), (2, 8)')
+		database.execute_sql("INSERT INTO coordinate VALUES (1, 1, 'a'), (2, 2, 'b'), (3, 1, 'c')")
+		migrations.add_coordinate_team(database)
+		migrations.add_coordinate_team(database)  # Already applied, a no-op
+		self.assertEqual(database.execute_sql('SELECT id, team_id FROM coordinate ORDER BY id').fetchall(),
+						 [(1, 7), (2, 8), (3, 7)])
+
+	def test_within_bbox(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, CoordinateRTree)):
+			UserModelTestCase.create_users()
+			user = User.select().get()
+			for name, latitude, published in (('Inside', 37.3, True), ('Outside', 40.1, True), ('Hidden', 37.4, False)):
+				self.create_points(name, latitude=latitude, longitude=-113.9, published=published)
+			self.assertEqual(
+				[point.name for point in Coordinate.within_bbox(37, -114, 38, -113)],
+				['Inside']
+			)
+			self.assertEqual(
+				sorted(point.name for point in Coordinate.within_bbox(37, -114, 38, -113, user=user)),
+				['Hidden', 'Inside']
+			)
+			# An index created after the points is filled in from the coordinate table
+			CoordinateRTree.drop_table()
+			CoordinateRTree.create_table()
+			self.assertEqual(
+				[point.name for point in Coordinate.within_bbox(37, -114, 38, -113)],
+				['Inside']
+			)
+
+	def test_nearest(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, CoordinateRTree)):
+			UserModelTestCase.create_users()
+			for name, latitude in (('Near', 37.31), ('Middle', 37.5), ('Far', 45.0)):
+				self.create_points(name, latitude=latitude, longitude=-113.96)
+			nearest = Coordinate.nearest(37.3, -113.96, k=2)
+			self.assertEqual([point.name for point, _ in nearest], ['Near', 'Middle'])
+			self.assertAlmostEqual(nearest[0][1], 1.112, places=2)
+
+	def test_search(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, CoordinateFTS)):
+			UserModelTestCase.create_users()
+			user = User.select().get()
+			for name, notes, published in (('Big Sagebrush', 'Artemisia tridentata <b>', True),
+										   ('Black Sagebrush', 'Artemisia nova', False),
+										   ('Juniper', 'Sagebrush nearby', True)):
+				self.create_points(name, notes=notes, published=published)
+			self.assertEqual([point.name for point in Coordinate.search('artemisia')], ['Big Sagebrush'])
+			self.assertEqual(
+				sorted(point.name for point in Coordinate.search('artem*', user=user)),
+				['Big Sagebrush', 'Black Sagebrush']
+			)
+			self.assertEqual([point.name for point in Coordinate.search('"big sagebrush"')], ['Big Sagebrush'])
+			self.assertEqual(
+				[point.name for point in Coordinate.search('sagebrush')],
+				['Big Sagebrush', 'Juniper']  # Name matches rank first
+			)
+			self.assertEqual(Coordinate.search('tridentata').get().snippet, 'Artemisia \x02tridentata\x03 <b>')
+			self.assertEqual(Coordinate.search('" *').count(), 0)
+			CoordinateFTS.rebuild_index()
+			self.assertEqual([point.name for point in Coordinate.search('artemisia')], ['Big Sagebrush'])
+			self.assertEqual(Coordinate.search('artem*', user=user).count(), 2)
+
+	def test_suggest(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, CoordinateNameFTS)):
+			UserModelTestCase.create_users()
+			user = User.select().get()
+			for name, published in (('Artemisia nova', True), ('Artemisia nova', True),
+									('Artemisia tridentata', True), ('Artemisia arbuscula', False),
+									('Site 12-B', True), ("O'Neil Spring", True)):
+				self.create_points(name, published=published)
+			self.assertEqual(Coordinate.suggest('arte'), ['Artemisia nova', 'Artemisia tridentata'])
+			self.assertEqual(Coordinate.suggest('artemisia tri'), ['Artemisia tridentata'])
+			self.assertEqual(Coordinate.suggest('arb'), [])
+			self.assertEqual(Coordinate.suggest('arb', user=user), ['Artemisia arbuscula'])
+			self.assertEqual(Coordinate.suggest('art', limit=1), ['Artemisia nova'])
+			self.assertEqual(Coordinate.suggest('Site 12-B'), ['Site 12-B'])
+			self.assertEqual(Coordinate.suggest('site 12-'), ['Site 12-B'])
+			self.assertEqual(Coordinate.suggest("O'Neil sp"), ["O'Neil Spring"])
+			self.assertEqual(Coordinate.suggest('"o\'ne'), ["O'Neil Spring"])
+			self.assertEqual(Coordinate.suggest('" - *'), [])
+			# An index created after the points is filled in from the coordinate table
+			CoordinateNameFTS.drop_table()
+			CoordinateNameFTS.create_table()
+			self.assertEqual(Coordinate.suggest('arb'), [])
+			self.assertEqual(Coordinate.suggest('arb', user=user), ['Artemisia arbuscula'])
+
+	def test_search_cache(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, CoordinateFTS, DataVersion)):
+			UserModelTestCase.create_users()
+			cache = SearchCache(max_ids=2)
+			self.create_points('Artemisia nova', 'Artemisia tridentata')
+			ids = cache.ids('Artemisia')
+			self.assertEqual(len(ids), 2)
+			self.assertIs(cache.ids('  artemisia '), ids)
+			self.create_points('Artemisia arbuscula')
+			self.assertEqual(len(cache.ids('artemisia')), 3)
+			self.assertIsNot(cache.ids('artemisia'), cache.ids('artemisia'))  # Too many ids to be kept
+			self.assertEqual(
+				list(cache.ids('tridentata')),
+				[Coordinate.get(Coordinate.name == 'Artemisia tridentata').id]
+			)
+
+	def test_point_counts(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, PointCount)):
+			UserModelTestCase.create_users()
+			user = User.select().get()
+			for name, published in (('Public', True), ('Private', False), ('Other', False)):
+				self.create_points(name, published=published)
+			self.assertEqual((PointCount.public(), PointCount.private(user)), (1, 2))
+			point = Coordinate.get(Coordinate.name == 'Other')
+			point.published = True
+			point.save()
+			point = Coordinate.get(Coordinate.name == 'Private')
+			point.delete_instance()
+			self.assertEqual((PointCount.public(), PointCount.private(user)), (2, 0))
+			PointCount.update(count=10).execute()
+			PointCount.repair()
+			self.assertEqual((PointCount.public(), PointCount.private(user)), (2, 0))
+
+
+class PaginationTestCase(unittest.TestCase):
+	def test_keyset_pagination(self):
+		with test_database(TEST_DB, (Team, User, Coordinate)):
+			UserModelTestCase.create_users(1)
+			for day in range(1, 6):
+				CoordModelTestCase.create_points('Point {}'.format(day), latitude=37.3, longitude=-113.9,
+												 timestamp=datetime.datetime(2017, 7, day))
+
+			def names(page):
+				return [point.name for point in page.items]
+
+			first = KeysetPagination(Coordinate.public(), paginate_by=2)
+			self.assertEqual(names(first), ['Point 5', 'Point 4'])
+			self.assertFalse(first.has_previous())
+			self.assertTrue(first.has_next())
+
+			second = KeysetPagination(Coordinate.public(), paginate_by=2, **first.next_args())
+			self.assertEqual(names(second), ['Point 3', 'Point 2'])
+			self.assertTrue(second.has_previous())
+
+			last = KeysetPagination(Coordinate.public(), paginate_by=2, **second.next_args())
+			self.assertEqual(names(last), ['Point 1'])
+			self.assertFalse(last.has_next())
+
+			back = KeysetPagination(Coordinate.public(), paginate_by=2, **second.previous_args())
+			self.assertEqual(names(back), ['Point 5', 'Point 4'])
+			self.assertFalse(back.has_previous())
+			self.assertTrue(back.has_next())
+
+			# A cursor keeps working after its point is gone
+			Coordinate.delete().where(Coordinate.name == 'Point 2').execute()
+			stale = KeysetPagination(Coordinate.public(), paginate_by=2, **second.next_args())
+			self.assertEqual(names(stale), ['Point 1'])
+
+			# Unreadable cursors start from the first page
+			for token in ('garbage', encode_cursor(Coordinate.get())[:-4], ''):
+				self.assertEqual(names(KeysetPagination(Coordinate.public(), paginate_by=2, after=token)),
+								 ['Point 5', 'Point 4'])
+
+	def test_decode_cursor(self):
+		self.assertEqual(decode_cursor('WyIyMDE3LTA3LTAxIDAwOjAwOjAwIiwgM10='), ('2017-07-01 00:00:00', 3))
+		self.assertIsNone(decode_cursor('garbage'))
+		self.assertIsNone(decode_cursor('WyJvbmx5Il0='))  # ["only"]
+		self.assertIsNone(decode_cursor('WyIyMDE3IiwgIngiXQ=='))  # ["2017", "x"]
+
+
+class ExportCacheTestCase(unittest.TestCase):
+	def test_evicted_while_read(self):
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		cache = exports.ExportCache(directory, max_size=1024)
+		self.assertIsNone(cache.get('Sagebrush', 'csv', 1))
+		self.assertEqual(b''.join(cache.store('Sagebrush', 'csv', 1, [b'old,', b'rows'])), b'old,rows')
+		cached = cache.get('  sagebrush ', 'csv', 1)
+		# A write lands and another download evicts the older version
+		list(cache.store('Sagebrush', 'csv', 2, [b'new rows']))
+		cache.evict(2)
+		self.assertIsNone(cache.get('Sagebrush', 'csv', 1))
+		self.assertEqual(b''.join(exports.iter_file(cached)), b'old,rows')
+
+class UploadJobModelTestCase(unittest.TestCase):
+	def test_claim(self):
+		with test_database(TEST_DB, (Team, User, UploadJob)):
+			UserModelTestCase.create_users(1)
+			user = User.select().get()
+			first = UploadJob.enqueue(user, 'first.txt', False)
+			second = UploadJob.enqueue(user, 'second.txt', True)
+			claimed = UploadJob.claim()
+			self.assertEqual(claimed.id, first.id)
+			self.assertEqual(claimed.status, UploadJob.RUNNING)
+			self.assertEqual(UploadJob.claim().id, second.id)
+			self.assertIsNone(UploadJob.claim())
+
+	def test_fail_stale(self):
+		with test_database(TEST_DB, (Team, User, UploadJob)):
+			UserModelTestCase.create_users(1)
+			UploadJob.enqueue(User.select().get(), 'points.txt', False)
+			job = UploadJob.claim()
+			self.assertEqual(UploadJob.fail_stale(), 0)
+			UploadJob.update(heartbeat_at=job.heartbeat_at - UploadJob.STALE_AFTER * 2).execute()
+			self.assertIsNone(UploadJob.claim())
+			job = UploadJob.get()
+			self.assertEqual(job.status, UploadJob.FAILED)
+			self.assertEqual(len(job.progress()['errors']), 1)
+
+	def test_run_job(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, UploadJob)):
+			UserModelTestCase.create_users(1)
+			with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+				f.write('39.01,-113.26,First,RED MAP PIN\nnorth,-113.27,Second,RED MAP PIN\n')
+			self.addCleanup(os.remove, f.name)
+			UploadJob.enqueue(User.select().get(), f.name, True)
+			upload_worker.work(once=True)
+			progress = UploadJob.get().progress()
+			self.assertEqual(progress['status'], UploadJob.DONE)
+			self.assertEqual((progress['accepted'], progress['rejected']), (1, 1))
+			self.assertEqual(progress['errors'][0]['name'], 'Second')
+			self.assertEqual(Coordinate.select().count(), 1)
+
+
+class IngestTestCase(unittest.TestCase):
+	@staticmethod
+	def point(user, name, latitude=39.01, longitude=-113.26):
+		return {'user': user, 'team': user.team_id, 'latitude': latitude, 'longitude': longitude,
+				'name': name, 'pin': 'RED MAP PIN', 'notes': 'Uploaded from file.', 'published': True}
+
+	def test_iter_gpx(self):
+		with tempfile.NamedTemporaryFile('w', suffix='.gpx', delete=False) as f:
+			f.write('<?xml version="1.0"?>\n<gpx xmlns="http://www.topografix.com/GPX/1/1">'
+					'<metadata><name>Survey</name></metadata>'
+					'<trk><name>Track</name><trkseg>{}</trkseg></trk>'
+					'<rte><rtept lat="39.03" lon="-113.28"><name>Route</name><sym>Flag</sym></rtept></rte>'
+					'<wpt lat="39.01" lon="-113.26"><name>First</name><sym>RED MAP PIN</sym></wpt>'
+					'<wpt lat="39.02" lon="-113.27"><name>Second</name><sym>RED MAP PIN</sym></wpt>'
+					'<wpt lat="39.04" lon="-113.29"><name>No pin</name></wpt>'
+					'</gpx>'.format('<trkpt lat="39.0" lon="-113.0"/>' * 1000))
+		self.addCleanup(os.remove, f.name)
+		roots = []
+		parse = ingest.ET.iterparse
+		def iterparse(*args, **kwargs):
+			for event, elem in parse(*args, **kwargs):
+				if not roots:
+					roots.append(elem)
+				yield event, elem
+		with mock.patch.object(ingest.ET, 'iterparse', iterparse):
+			points = ingest.iter_gpx(f.name)
+			self.assertEqual(next(points), ('39.01', '-113.26', 'First', 'RED MAP PIN'))
+			# The metadata, track and route were dropped once read
+			self.assertEqual([child.tag for child in roots[0] if child.tag[-3:] != 'wpt'], [])
+			self.assertEqual(list(points), [('39.02', '-113.27', 'Second', 'RED MAP PIN')])
+
+	def test_insert_batch(self):
+		with test_database(TEST_DB, (Team, User, Coordinate)):
+			UserModelTestCase.create_users(1)
+			user = User.select().get()
+			CoordModelTestCase.create_points('Taken', latitude=39.0, longitude=-113.0)
+			rows = [self.point(user, 'Fresh'), self.point(user, 'Taken')]
+			rows[0]['slug'], rows[1]['slug'] = 'fresh', 'taken'
+			# A statement per row
+			with mock.patch('models.max_sql_variables', return_value=len(ingest.COLUMNS)):
+				self.assertEqual(ingest.insert_batch(rows), {'fresh'})
+			self.assertEqual(Coordinate.get(Coordinate.slug == 'taken').latitude, 39.0)
+			rows = [self.point(user, 'Other')]
+			rows[0]['slug'] = 'other'
+			self.assertEqual(ingest.insert_batch(rows), {'other'})
+			self.assertEqual(Coordinate.select().count(), 3)
+
+	def test_save_to_database(self):
+		with test_database(TEST_DB, (Team, User, Coordinate)):
+			UserModelTestCase.create_users(1)
+			user = User.select().get()
+			CoordModelTestCase.create_points('Stored', latitude=39.0, longitude=-113.0)
+			points = [self.point(user, 'First'), self.point(user, 'Bad', latitude='north'),
+					  self.point(user, 'First'), self.point(user, 'Far', longitude=200),
+					  self.point(user, ' '), self.point(user, 'Stored')]
+			# Another upload storing the same slug after it was allocated
+			with mock.patch.object(SlugAllocator, '_load_existing'):
+				report = ingest.save_to_database(points, size=4)
+			self.assertEqual(report.accepted, 2)
+			self.assertEqual([row for row, name, reason in report.rejected], [2, 4, 5, 6])
+			self.assertEqual(report.rejected[3], (6, 'Stored', 'conflicts with a stored point'))
+			self.assertEqual(sorted(c.slug for c in Coordinate.select()), ['first', 'first-2', 'stored'])
+
 
 class ViewTestCase(unittest.TestCase):
 	def setUp(self):
@@ -172,6 +527,168 @@ class CoordinateViewsTestCase(ViewTestCase):
 			rv = self.app.get('/private')
 			self.assertNotIn(point_data['name'], rv.get_data(as_text=True))
 
+	def test_api_points(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, CoordinateRTree)):
+			UserModelTestCase.create_users(1)
+			CoordModelTestCase.create_points('First', 'Second', latitude=37.3, longitude=-113.9)
+			rv = self.app.get('/api/points?bbox=-114,37,-113,38')
+			self.assertEqual(len(rv.get_json()['features']), 2)
+			for limit in (-1, 0, 1):
+				rv = self.app.get('/api/points?bbox=-114,37,-113,38&limit={}'.format(limit))
+				self.assertEqual(len(rv.get_json()['features']), 1)
+			rv = self.app.get('/api/points?bbox=north')
+			self.assertEqual(rv.status_code, 400)
+
+	def test_download_order(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, DataVersion)):
+			UserModelTestCase.create_users(1)
+			self.app.post('/login', data=LOGIN_USER_DATA)
+			CoordModelTestCase.create_points('Older', 'Newer', latitude=37.3, longitude=-113.9)
+			# Exports cached by other tests may share the data version of this one
+			cache_folder = tempfile.mkdtemp()
+			self.addCleanup(shutil.rmtree, cache_folder)
+			with mock.patch.dict(sos_tracker.app.config, {'EXPORT_CACHE_FOLDER': cache_folder}):
+				rv = self.app.post('/download', data={'filename': 'points', 'format': 'csv'})
+				content = rv.get_data(as_text=True)
+			self.assertLess(content.index('Newer'), content.index('Older'))
+
+	def test_point_delete(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, Visit, WeatherDay, Weather)):
+			UserModelTestCase.create_users(1)
+			self.app.post('/login', data=LOGIN_USER_DATA)
+			point = CoordModelTestCase.create_points('Test Coord', latitude=39.012566, longitude=-113.261538)[0]
+			WeatherDay.create(coordinate=point, valid_date='2017-07-14', source=WeatherDay.FORECAST, tmin=40, tmax=80)
+			rv = self.app.post('/{}/edit'.format(point.slug), data={'submit': 'Delete'})
+			self.assertEqual(rv.status_code, 302)
+			self.assertEqual(Coordinate.select().count(), 0)
+			self.assertEqual(WeatherDay.select().count(), 0)
+			self.assertEqual(Weather.select().count(), 0)
+
+	def test_conditional_get(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, DataVersion)):
+			rv = self.app.get('/')
+			etag = rv.headers['ETag']
+			self.assertIn('no-cache', rv.headers['Cache-Control'])
+			rv = self.app.get('/', headers={'If-None-Match': etag})
+			self.assertEqual(rv.status_code, 304)
+			self.assertEqual(rv.get_data(), b'')
+			UserModelTestCase.create_users(1)
+			CoordModelTestCase.create_points('Public Test Coord', latitude=39.012566, longitude=-113.261538)
+			rv = self.app.get('/', headers={'If-None-Match': etag})
+			self.assertEqual(rv.status_code, 200)
+			self.assertIn('Public Test Coord', rv.get_data(as_text=True))
+
+
+	def test_conditional_get_private(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, DataVersion, PointCount)):
+			UserModelTestCase.create_users(1)
+			self.app.post('/login', data=LOGIN_USER_DATA)
+			self.app.get('/private')  # Shows the login message, never cached
+			etag = self.app.get('/private').headers['ETag']
+			rv = self.app.get('/private', headers={'If-None-Match': etag})
+			self.assertEqual(rv.status_code, 304)
+			# Changing team updates no points of a user who has none
+			Team.create_team(name='Other Team', institution='University of Utah', code='Testing456')
+			User.update(team=Team.get(Team.name == 'Other Team')).execute()
+			rv = self.app.get('/private', headers={'If-None-Match': etag})
+			self.assertEqual(rv.status_code, 200)
+
+class UploadViewsTestCase(ViewTestCase):
+	def setUp(self):
+		super(UploadViewsTestCase, self).setUp()
+		self.upload_folder = sos_tracker.app.config['UPLOAD_FOLDER']
+		sos_tracker.app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(sos_tracker.app.config['UPLOAD_FOLDER'])
+		sos_tracker.app.config['UPLOAD_FOLDER'] = self.upload_folder
+
+	def upload(self, content, filename='points.txt'):
+		return self.app.post('/upload', data={'file': (io.BytesIO(content), filename)})
+
+	def test_upload_same_name(self):
+		with test_database(TEST_DB, (Team, User, UploadJob)):
+			UserModelTestCase.create_users(1)
+			self.app.post('/login', data=LOGIN_USER_DATA)
+			self.upload(b'39.01,-113.26,First,RED MAP PIN\n')
+			self.upload(b'39.02,-113.27,Second,RED MAP PIN\n')
+			first, second = UploadJob.select().order_by(UploadJob.id)
+			self.assertNotEqual(first.path, second.path)
+			with open(first.path) as f:
+				self.assertIn('First', f.read())
+			with open(second.path) as f:
+				self.assertIn('Second', f.read())
+
+	def test_upload_status(self):
+		with test_database(TEST_DB, (Team, User, UploadJob)):
+			UserModelTestCase.create_users(2)
+			self.app.post('/login', data=LOGIN_USER_DATA)
+			own = UploadJob.enqueue(User.get(User.email == LOGIN_USER_DATA['email']), 'points.txt', False)
+			other = UploadJob.enqueue(User.get(User.email == 'test_1@example.com'), 'points.txt', False)
+			rv = self.app.get('/upload/{}/status'.format(own.id))
+			self.assertEqual(rv.status_code, 200)
+			self.assertEqual(rv.get_json()['status'], UploadJob.QUEUED)
+			rv = self.app.get('/upload/{}/status'.format(other.id))
+			self.assertEqual(rv.status_code, 404)
+
+
+class WeatherUpdateTestCase(unittest.TestCase):
+	def test_parse_forecast(self):
+		days = [{'time': 1500000000 + day * 86400, 'precipIntensityMax': 0.1, 'temperatureMin': 40 + day, 'temperatureMax': 80}
+				for day in range(weather_update.FORECAST_DAYS + 1)]
+		days[2]['precipAccumulation'] = 1.5
+		parsed = weather_update.parse_forecast({'daily': {'summary': 'Sunny', 'data': days}})
+		self.assertEqual(len(parsed), weather_update.FORECAST_DAYS)
+		self.assertEqual(parsed[0], ('2017-07-14', 0, WeatherDay.FORECAST, 'Sunny', 0.1, 0, 40, 80))
+		self.assertEqual(parsed[2][5], 1.5)
+		self.assertEqual(parsed[7][:4], ('2017-07-21', 7, WeatherDay.FORECAST, None))
+
+	def test_group_by_cell(self):
+		points = [(1, 39.0121, -113.2612), (2, 39.0149, -113.2588), (3, 39.0251, -113.2612)]
+		cells = weather_update.group_by_cell(points, grid=0.01)
+		self.assertEqual(dict(cells), {(39.01, -113.26): [1, 2], (39.03, -113.26): [3]})
+		self.assertEqual(len(weather_update.group_by_cell(points, grid=0)), 3)
+
+	def test_cell_forecast_cache(self):
+		with test_database(TEST_DB, (CellForecast,)):
+			issued = weather_update.issue_time(now=1500001234, interval=3600)
+			self.assertEqual(issued, 1500001200)
+			CellForecast.store([((39.01, -113.26), {'daily': 'old'})], issued - 3600)
+			CellForecast.store([((39.01, -113.26), {'daily': 'new'})], issued)
+			self.assertEqual(CellForecast.cached(issued), {(39.01, -113.26): {'daily': 'new'}})
+			CellForecast.prune(issued)
+			self.assertEqual(CellForecast.select().count(), 1)
+
+	def test_save_forecasts(self):
+		with test_database(TEST_DB, (Team, User, Coordinate, WeatherDay, Weather, CellForecast)):
+			UserModelTestCase.create_users(1)
+			point = CoordModelTestCase.create_points('Test Coord', latitude=39.012566, longitude=-113.261538)[0]
+			days = [{'time': 1500000000 + day * 86400, 'precipIntensityMax': 0.1, 'temperatureMin': 40, 'temperatureMax': 80}
+					for day in range(weather_update.FORECAST_DAYS)]
+			for temperature in (40, 45):
+				days[0]['temperatureMin'] = temperature
+				writer = weather_update.ForecastWriter(issued=1500001200, batch=1)
+				writer.add((39.01, -113.26), [point.id], {'daily': {'summary': 'Sunny', 'data': days}})
+				self.assertEqual(writer.written, weather_update.FORECAST_DAYS)
+			self.assertEqual(WeatherDay.select().count(), weather_update.FORECAST_DAYS)
+			self.assertEqual(len(CellForecast.cached(1500001200)), 1)
+			# The compatibility view folds the days back into one row
+			self.assertEqual(Weather.select().count(), 1)
+			weather = Weather.get()
+			self.assertEqual(weather.day_summary, 'Sunny')
+			self.assertEqual(weather.ft_0_temp_min, 45)
+			self.assertEqual(weather.ft_7_time, 1500595200)
+			self.assertEqual(Coordinate.get_coords_without_weather(WeatherDay.DAYMET).count(), 1)
+			self.assertEqual(Coordinate.get_coords_without_weather().count(), 0)
+
+	def test_token_bucket(self):
+		bucket = weather_update.TokenBucket(rate=1000, capacity=2)
+		bucket.acquire()
+		bucket.acquire()
+		self.assertLess(bucket.tokens, 1)
+		bucket.acquire()
+		self.assertLess(bucket.tokens, 1)
+
 
 if __name__ == '__main__':
 	unittest.main()
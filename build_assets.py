@@ -0,0 +1,142 @@
+"""
+Fingerprint and precompress the static files.
+
+Every file under static/ is copied to static/dist/ with a hash of its content
+in the name, next to .gz and, if the brotli package is installed, .br
+variants. static/dist/manifest.json maps the original names to the
+fingerprinted ones for asset_url() in the templates. Stylesheets have their
+relative url() references rewritten to the fingerprinted names first. Run it
+whenever the static files change, e.g. on deploy:
+
+    python build_assets.py
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_FOLDER = os.path.join(STATIC_FOLDER, 'dist')
+MANIFEST = os.path.join(DIST_FOLDER, 'manifest.json')
+
+# Formats that are already compressed gain nothing from gzip or brotli
+PRECOMPRESSED = ('.woff', '.woff2', '.png', '.jpg', '.jpeg', '.gif', '.ico')
+
+# Smallest file worth storing compressed variants of
+MIN_COMPRESS_SIZE = 256
+
+_css_url = re.compile(r'''url\((['"]?)([^'")?#]+)([^'")]*)\1\)''')
+_source_map = re.compile(r'sourceMappingURL=(\S+?)(\s*\*/)')
+
+
+def load_manifest(path=MANIFEST):
+    """The {source name: fingerprinted name} mapping of the last build, empty if there was none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def fingerprinted(name, content):
+    stem, extension = posixpath.splitext(name)
+    return '{}.{}{}'.format(stem, hashlib.sha256(content).hexdigest()[:12], extension)
+
+
+def rewrite_css(name, content, manifest):
+    """Point the relative url() and source map references of a stylesheet at their fingerprinted files."""
+    folder = posixpath.dirname(name)
+
+    def resolve(target):
+        source = posixpath.normpath(posixpath.join(folder, target))
+        return posixpath.relpath(manifest[source], folder) if source in manifest else None
+
+    def replace_url(match):
+        quote, target, suffix = match.groups()
+        return 'url({0}{1}{2}{0})'.format(quote, resolve(target), suffix) if resolve(target) else match.group(0)
+
+    def replace_source_map(match):
+        target, end = match.groups()
+        return 'sourceMappingURL={}{}'.format(resolve(target), end) if resolve(target) else match.group(0)
+
+    content = _css_url.sub(replace_url, content.decode('utf-8'))
+    return _source_map.sub(replace_source_map, content).encode('utf-8')
+
+
+def write_variants(path, content):
+    """Write a file with its gzip and brotli variants, returning the paths written."""
+    written = [path]
+    with open(path, 'wb') as f:
+        f.write(content)
+    if path.endswith(PRECOMPRESSED) or len(content) < MIN_COMPRESS_SIZE:
+        return written
+    with open(path + '.gz', 'wb') as f:
+        # A fixed mtime keeps the output identical between builds
+        with gzip.GzipFile(filename='', fileobj=f, mode='wb', compresslevel=9, mtime=0) as compressed:
+            compressed.write(content)
+    written.append(path + '.gz')
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+        written.append(path + '.br')
+    return written
+
+
+def sources(folder=STATIC_FOLDER, dist=DIST_FOLDER):
+    """Names of the static files relative to `folder`, stylesheets last so their references are known."""
+    names = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+        for filename in files:
+            names.append(posixpath.join(*os.path.relpath(os.path.join(root, filename), folder).split(os.sep)))
+    return sorted(names, key=lambda name: (name.endswith('.css'), name))
+
+
+def build(folder=STATIC_FOLDER, dist=DIST_FOLDER):
+    """Build dist from folder, removing files of earlier builds. Returns the manifest."""
+    manifest = {}
+    written = set()
+    for name in sources(folder, dist):
+        with open(os.path.join(folder, *name.split('/')), 'rb') as f:
+            content = f.read()
+        if name.endswith('.css'):
+            content = rewrite_css(name, content, manifest)
+        manifest[name] = fingerprinted(name, content)
+        path = os.path.join(dist, *manifest[name].split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written.update(write_variants(path, content))
+
+    for root, dirs, files in os.walk(dist):
+        for filename in files:
+            path = os.path.join(root, filename)
+            if path not in written and path != os.path.join(dist, 'manifest.json'):
+                os.remove(path)
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clean', action='store_true', help='remove static/dist instead of building it')
+    args = parser.parse_args()
+
+    if args.clean:
+        shutil.rmtree(DIST_FOLDER, ignore_errors=True)
+        return
+    manifest = build()
+    print("[*] {} assets written to {}{}".format(
+        len(manifest), DIST_FOLDER, '' if brotli else ' (install brotli for .br variants)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Export coordinates to files for ArcGIS and GPS units.
+
+Rows are read from the database with a server-side cursor and written out as
+they arrive, so memory use stays constant however many points are exported.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
+
+from openpyxl import Workbook
+
+from models import Coordinate, normalize_search
+
+HEADER = ('Latitude', 'Longitude', 'Name', 'Pin', 'Notes')
+COLUMNS = (Coordinate.latitude, Coordinate.longitude, Coordinate.name, Coordinate.pin, Coordinate.notes)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Size of the pieces a file is sent to the client in
+CHUNK_SIZE = 64 * 1024
+
+# Number of points serialized per chunk by the text based formats
+ROWS_PER_CHUNK = 1000
+
+# Exports smaller than this are built in memory, larger ones spill to an anonymous temporary file
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def iter_rows(query):
+    """Yield (latitude, longitude, name, pin, notes) tuples for the points of a query.
+
+    The query only runs once the first row is requested, which for streamed
+    responses is after the view has returned.
+    """
+    for row in query.select(*COLUMNS).tuples().iterator():
+        yield row
+
+
+def write_xlsx(rows, fileobj):
+    """Create ArcGIS compatible workbook using openpyxl's write-only mode."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(HEADER)
+    for row in rows:
+        ws.append(row)
+    wb.save(fileobj)
+
+
+def iter_file(fileobj):
+    """Yield the contents of a file in chunks, closing it once exhausted."""
+    try:
+        fileobj.seek(0)
+        while True:
+            chunk = fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+def xlsx_chunks(query):
+    """Build the workbook for a query and return a generator over its bytes."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    write_xlsx(iter_rows(query), spool)
+    return iter_file(spool)
+
+
+def feature(latitude, longitude, **properties):
+    """GeoJSON Point feature for a coordinate."""
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': properties,
+    }
+
+
+def iter_text(rows, header, footer, render):
+    """Render rows to text in batches, yielding utf-8 encoded chunks."""
+    yield header.encode('utf-8')
+    buffer = []
+    for row in rows:
+        buffer.append(render(row))
+        if len(buffer) >= ROWS_PER_CHUNK:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+    yield footer.encode('utf-8')
+
+
+def csv_chunks(query):
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    def render(row):
+        out.seek(0)
+        out.truncate()
+        writer.writerow(row)
+        return out.getvalue()
+
+    return iter_text(iter_rows(query), render(HEADER), '', render)
+
+
+def geojson_chunks(query):
+    """GeoJSON FeatureCollection with one Point feature per coordinate."""
+    first = [True]
+
+    def render(row):
+        latitude, longitude, name, pin, notes = row
+        rendered = json.dumps(feature(latitude, longitude, name=name, pin=pin, notes=notes))
+        if first[0]:
+            first[0] = False
+            return rendered
+        return ',' + rendered
+
+    return iter_text(iter_rows(query), '{"type": "FeatureCollection", "features": [', ']}', render)
+
+
+def gpx_chunks(query):
+    """GPX 1.1 document with one waypoint per coordinate."""
+    def render(row):
+        latitude, longitude, name, pin, notes = row
+        return '<wpt lat={} lon={}><name>{}</name><desc>{}</desc><sym>{}</sym></wpt>\n'.format(
+            quoteattr(str(latitude)), quoteattr(str(longitude)),
+            escape(name or ''), escape(notes or ''), escape(pin or ''))
+
+    header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<gpx version="1.1" creator="SOS Tracker" xmlns="http://www.topografix.com/GPX/1/1">\n')
+    return iter_text(iter_rows(query), header, '</gpx>\n', render)
+
+
+# Download formats: (file extension, mimetype, chunk generator)
+FORMATS = {
+    'xls': ('.xls', XLSX_MIMETYPE, xlsx_chunks),
+    'csv': ('.csv', 'text/csv', csv_chunks),
+    'geojson': ('.geojson', 'application/geo+json', geojson_chunks),
+    'gpx': ('.gpx', 'application/gpx+xml', gpx_chunks),
+}
+
+
+class ExportCache(object):
+    """Generated export files kept on disk.
+
+    Files are named after the data version they were built from and a hash of
+    the normalized search and format, so any write to the coordinates makes
+    every older entry unreachable. Once the directory grows past `max_size`
+    bytes the least recently used files are removed.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, search, fmt, version):
+        digest = hashlib.sha1(json.dumps([normalize_search(search), fmt]).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{}-{}'.format(version, digest))
+
+    def get(self, search, fmt, version):
+        """Open a cached export for reading or return None, marking it as recently used.
+
+        Once open the file stays readable even if another worker evicts it.
+        """
+        path = self.path(search, fmt, version)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return f
+
+    def store(self, search, fmt, version, chunks):
+        """Yield chunks while writing them to the cache, the entry appears only once complete."""
+        path = self.path(search, fmt, version)
+        fd, partial = tempfile.mkstemp(dir=self.directory, suffix='.partial')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        self.evict(version)
+
+    def evict(self, version):
+        """Remove entries of other data versions, then the least recently used until under max_size.
+
+        Other workers may be evicting at the same time, entries they removed first are skipped.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.partial'):
+                continue
+            try:
+                if not entry.name.startswith('{}-'.format(version)):
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
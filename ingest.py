@@ -0,0 +1,199 @@
+"""
+Streaming ingestion of uploaded GPS files.
+
+Waypoints are read one at a time (incremental XML parsing for .gpx, line by
+line for .txt) and written to the database in fixed-size batches, so memory
+use stays flat no matter how large the uploaded file is.
+"""
+import csv
+import datetime
+import itertools
+import xml.etree.ElementTree as ET
+
+import models
+
+# Number of parsed points written to the database per transaction
+BATCH_SIZE = 5000
+
+# Coordinate columns written by insert_batch, all but the primary key
+COLUMNS = [field for field in models.Coordinate._meta.sorted_fields if not field.primary_key]
+
+# Compiled INSERT statements by number of rows
+_insert_statements = {}
+
+
+class IngestReport(object):
+    """Per-row outcome of loading an uploaded file."""
+
+    def __init__(self):
+        self.accepted = 0
+        # (row number, point name, reason) for every point that wasn't stored
+        self.rejected = []
+
+    def reject(self, row, name, reason):
+        self.rejected.append((row, name, reason))
+
+    def summary(self, limit=5):
+        """Short human readable description of the rejected rows."""
+        details = ', '.join('row {} ({}): {}'.format(*rejected) for rejected in self.rejected[:limit])
+        if len(self.rejected) > limit:
+            details += ' and {} more'.format(len(self.rejected) - limit)
+        return details
+
+
+def iter_txt(path):
+    """Yield (latitude, longitude, name, pin) tuples from a comma separated file."""
+    with open(path, 'r', newline='') as f:
+        for line in csv.reader(f):
+            # To avoid index out of bound errors
+            if len(line) >= 4:
+                yield line[0], line[1], line[2], line[3]
+
+
+def iter_gpx(path):
+    """Yield (latitude, longitude, name, pin) tuples from the waypoints of a GPX file.
+
+    Direct children of the root (waypoints, tracks, routes...) are discarded
+    as soon as they have been read so the document tree never grows beyond
+    a single one of them.
+    """
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth:
+            continue
+        if elem.tag[-3:] == 'wpt':
+            name = None
+            pin = None
+            for tag in elem:
+                if tag.tag[-4:] == 'name':
+                    name = tag.text
+                elif tag.tag[-3:] == 'sym':
+                    pin = tag.text
+            if name and pin:
+                yield elem.attrib['lat'], elem.attrib['lon'], name, pin
+        root.clear()
+
+
+def parse_file(path, user, publish):
+    """Lazily parse an uploaded file into coordinate dictionaries."""
+    if path[-3:] == 'txt':
+        points = iter_txt(path)
+    elif path[-3:] == 'gpx':
+        points = iter_gpx(path)
+    else:
+        return
+
+    for lat, lon, name, pin in points:
+        yield {'user': user,
+               'team': user.team_id,
+               'latitude': lat,
+               'longitude': lon,
+               'name': name,
+               'pin': pin,
+               'notes': 'Uploaded from file.',
+               'published': publish
+               }
+
+
+def batched(iterable, size):
+    """Split an iterable into lists of at most `size` items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def validate(point):
+    """Coerce a parsed point in place, returning the reason it is unusable or None."""
+    try:
+        point['latitude'] = float(point['latitude'])
+        point['longitude'] = float(point['longitude'])
+    except (TypeError, ValueError):
+        return 'latitude and longitude must be numbers'
+    if not -90 <= point['latitude'] <= 90 or not -180 <= point['longitude'] <= 180:
+        return 'coordinates out of range'
+    if not point['name'] or not point['name'].strip():
+        return 'missing name'
+    return None
+
+
+def insert_statement(rows):
+    """SQL of an INSERT OR IGNORE of `rows` coordinates, taking their column values in order."""
+    sql, _ = models.Coordinate.insert_many([[None] * len(COLUMNS)], fields=COLUMNS).on_conflict_ignore().sql()
+    head, values = sql.rsplit(' VALUES ', 1)
+    return '{} VALUES {}'.format(head, ', '.join([values] * rows))
+
+
+def insert_batch(rows):
+    """Insert rows, skipping any that conflict with stored points.
+
+    The multi-row INSERT OR IGNORE is compiled once per size instead of
+    having peewee build every VALUES list, which cost more than writing
+    them. Rows aren't inserted one statement at a time through executemany
+    like WeatherDay.upsert does: FTS5 flushes the index triggers' pending
+    terms at the end of each statement, which made that several times
+    slower. Returns the set of slugs that were actually written.
+    """
+    timestamp = datetime.datetime.now()
+    for row in rows:
+        row['timestamp'] = timestamp
+    size = max(1, models.max_sql_variables() // len(COLUMNS))
+    database = models.Coordinate._meta.database
+    inserted = 0
+    with database.atomic():
+        cursor = database.cursor()
+        for start in range(0, len(rows), size):
+            chunk = rows[start:start + size]
+            if len(chunk) not in _insert_statements:
+                _insert_statements[len(chunk)] = insert_statement(len(chunk))
+            cursor.execute(_insert_statements[len(chunk)],
+                           [field.db_value(row.get(field.name)) for row in chunk for field in COLUMNS])
+            inserted += cursor.rowcount
+        slugs = [row['slug'] for row in rows]
+        if inserted == len(rows):
+            return set(slugs)
+        return set(slug for slug, in (models.Coordinate
+                                      .select(models.Coordinate.slug)
+                                      .where(models.Coordinate.slug.in_(slugs) &
+                                             (models.Coordinate.timestamp == timestamp))
+                                      .tuples()))
+
+
+def save_to_database(data, size=None, progress=None):
+    """Insert parsed coordinates in batches of BATCH_SIZE.
+
+    Invalid rows and rows conflicting with stored points are rejected one by
+    one instead of failing their whole batch. `progress` is called with the
+    running report after every batch. Returns an IngestReport.
+    """
+    report = IngestReport()
+    slugs = models.SlugAllocator()
+    numbered = enumerate(data, 1)
+    for batch in batched(numbered, size or BATCH_SIZE):
+        valid = []
+        for row, point in batch:
+            reason = validate(point)
+            if reason:
+                report.reject(row, point['name'], reason)
+            else:
+                valid.append((row, point))
+        if valid:
+            for (row, point), slug in zip(valid, slugs.allocate(point['name'] for row, point in valid)):
+                point['slug'] = slug
+            inserted = insert_batch([point for row, point in valid])
+            for row, point in valid:
+                if point['slug'] in inserted:
+                    report.accepted += 1
+                else:
+                    report.reject(row, point['name'], 'conflicts with a stored point')
+        if progress:
+            progress(report)
+    return report
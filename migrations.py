@@ -0,0 +1,84 @@
+"""
+Schema upgrades for databases created by earlier versions of the app.
+
+Every step checks whether it is needed first, so upgrade() is run by
+models.initialize() on each start and is a no-op on fresh databases.
+"""
+from peewee import DateTimeField, ForeignKeyField
+from playhouse.migrate import SqliteMigrator, migrate
+
+import models
+
+
+def columns(database, table):
+    return [column.name for column in database.get_columns(table)]
+
+
+def add_coordinate_team(database):
+    """Add Coordinate.team and fill it in from the owner of each coordinate."""
+    if 'coordinate' not in database.get_tables() or 'team_id' in columns(database, 'coordinate'):
+        return
+    migrator = SqliteMigrator(database)
+    with database.atomic():
+        migrate(migrator.add_column('coordinate', 'team_id',
+                                    ForeignKeyField(models.Team, field=models.Team.id, null=True)))
+        database.execute_sql(
+            'UPDATE coordinate SET team_id = (SELECT team_id FROM "user" WHERE "user".id = coordinate.user_id)')
+
+
+def drop_ftscoord(database):
+    """Drop the FTS3/4 search index, replaced by models.CoordinateFTS which fills itself on creation."""
+    if 'ftscoord' not in database.get_tables():
+        return
+    with database.atomic():
+        for event in ('insert', 'update', 'delete'):
+            database.execute_sql('DROP TRIGGER IF EXISTS coordinate_search_{}'.format(event))
+        database.execute_sql('DROP TABLE ftscoord')
+
+
+def split_weather(database):
+    """Move the wide weather table into models.WeatherDay, a row per point, day and lead time.
+
+    Rows with only ft_0_* and no summary were written by weather_historical.py.
+    The weather table is dropped, models.Weather recreates it as a view.
+    """
+    if 'weather' not in database.get_tables():
+        return
+    with database.atomic():
+        models.WeatherDay.create_table()
+        for day in range(8):
+            # Later rows for the same day and lead time replace earlier ones, as forecasts do now
+            database.execute_sql(
+                """INSERT OR REPLACE INTO weatherday
+                    (coordinate_id, valid_date, lead_days, source, summary, precip_intensity_max, precip, tmin, tmax)
+                SELECT coordinate_id, date(ft_{0}_time + 43200, 'unixepoch'), {0},
+                    CASE WHEN day_summary IS NULL AND ft_1_time IS NULL THEN ? ELSE ? END,
+                    {1}, ft_{0}_precip_intensity_max, ft_{0}_precip_accumulation, ft_{0}_temp_min, ft_{0}_temp_max
+                FROM weather WHERE ft_{0}_time IS NOT NULL ORDER BY id""".format(day, 'day_summary' if day == 0 else 'NULL'),
+                (models.WeatherDay.DAYMET, models.WeatherDay.FORECAST))
+        database.execute_sql('DROP TABLE weather')
+
+
+def add_uploadjob_heartbeat(database):
+    """Add UploadJob.heartbeat_at, jobs running at the time fall back to their start time."""
+    if 'uploadjob' not in database.get_tables() or 'heartbeat_at' in columns(database, 'uploadjob'):
+        return
+    migrator = SqliteMigrator(database)
+    migrate(migrator.add_column('uploadjob', 'heartbeat_at', DateTimeField(null=True)))
+
+
+STEPS = (
+    add_coordinate_team,
+    drop_ftscoord,
+    split_weather,
+    add_uploadjob_heartbeat,
+)
+
+
+def upgrade(database=models.DATABASE):
+    for step in STEPS:
+        step(database)
+
+
+if __name__ == '__main__':
+    models.initialize()
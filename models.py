@@ -1,12 +1,37 @@
 import datetime
+import json
+import math
+import os
 import re
+import time
 
 from flask_bcrypt import generate_password_hash
 from flask_login import UserMixin
 from peewee import *
-from playhouse.sqlite_ext import FTSModel, SqliteExtDatabase, SearchField
+from peewee import NodeList
+from playhouse.pool import PooledSqliteExtDatabase
+from playhouse.sqlite_ext import FTS5Model, SearchField
 
-DATABASE = SqliteExtDatabase('sos.db')
+# Seconds a logged in user, with their team, is reused across requests before being read again
+IDENTITY_TTL = int(os.environ.get('SOS_IDENTITY_TTL', 30))
+
+# Seconds a connection waits for another process' write lock before giving up
+BUSY_TIMEOUT = int(os.environ.get('SOS_DATABASE_BUSY_TIMEOUT', 10))
+
+# Connections are pooled per process and opened on first use. WAL journaling
+# lets the web workers keep reading while the weather scripts write.
+DATABASE = PooledSqliteExtDatabase(
+    os.environ.get('SOS_DATABASE', 'sos.db'),
+    max_connections=int(os.environ.get('SOS_DATABASE_POOL_SIZE', 8)),
+    stale_timeout=300,
+    timeout=BUSY_TIMEOUT,
+    pragmas=(
+        ('journal_mode', 'wal'),
+        ('synchronous', os.environ.get('SOS_DATABASE_SYNCHRONOUS', 'normal')),
+        ('cache_size', -int(os.environ.get('SOS_DATABASE_CACHE_KB', 64 * 1024))),
+        ('mmap_size', int(os.environ.get('SOS_DATABASE_MMAP_SIZE', 256 * 1024 * 1024))),
+        ('busy_timeout', BUSY_TIMEOUT * 1000),
+    ))
 
 
 class Team(Model):
@@ -44,6 +69,16 @@ class Team(Model):
     def get_teams(cls):
         return Team.select()
 
+    def save(self, *args, **kwargs):
+        result = super(Team, self).save(*args, **kwargs)
+        IDENTITIES.clear()  # Every cached member holds a copy of the team
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super(Team, self).delete_instance(*args, **kwargs)
+        IDENTITIES.clear()
+        return result
+
 
 class User(UserMixin, Model):
     username = CharField(unique=True)
@@ -60,6 +95,11 @@ class User(UserMixin, Model):
         database = DATABASE
         order_by = ('-joined_at',)
 
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        super(User, cls).create_table(safe=safe, **options)
+        Coordinate.create_user_trigger(cls._meta.database)
+
     @classmethod
     def create_user(cls, username, email, password, team, admin=False):
         try:
@@ -78,6 +118,172 @@ class User(UserMixin, Model):
         """The users of a team."""
         return User.select().where(User.team == self.team)
 
+    def save(self, *args, **kwargs):
+        result = super(User, self).save(*args, **kwargs)
+        IDENTITIES.invalidate(self.id)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        user_id = self.id
+        result = super(User, self).delete_instance(*args, **kwargs)
+        IDENTITIES.invalidate(user_id)
+        return result
+
+
+class IdentityCache(object):
+    """Process wide cache of users, loaded together with their team, by id.
+
+    Every lookup returns fresh model instances so a request can't leak changes
+    into the cache. Saving a user or team through this process invalidates
+    their entries straight away, changes made by other processes are picked up
+    once the entries expire.
+    """
+
+    def __init__(self, ttl=IDENTITY_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        # Bumped on every invalidation so a lookup racing a save doesn't store the old row
+        self._generation = 0
+
+    def get(self, user_id):
+        """The user with the given id, raises User.DoesNotExist."""
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            generation = self._generation
+            user = (User
+                    .select(User, Team)
+                    .join(Team)
+                    .where(User.id == user_id)
+                    .get())
+            entry = (time.monotonic() + self.ttl, dict(user.__data__), dict(user.team.__data__))
+            if generation == self._generation:
+                self._entries[user_id] = entry
+        user = User(**entry[1])
+        user.team = Team(**entry[2])
+        user._dirty.clear()
+        return user
+
+    def invalidate(self, user_id):
+        self._generation += 1
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+
+IDENTITIES = IdentityCache()
+
+
+# Mean radius of the earth in kilometres
+EARTH_RADIUS = 6371.0088
+
+_max_sql_variables = None
+
+
+def max_sql_variables():
+    """Return the SQLITE_MAX_VARIABLE_NUMBER of the linked sqlite3 library.
+
+    Older builds allow only 999 parameters per statement while newer ones
+    allow 32766 or more. Python < 3.11 can't ask, so the limit is probed.
+    """
+    global _max_sql_variables
+    if _max_sql_variables is None:
+        import sqlite3
+        db = sqlite3.connect(':memory:')
+        if hasattr(db, 'getlimit'):
+            _max_sql_variables = db.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        else:
+            low, high = 1, 32767
+            while (high - 1) > low:
+                guess = (high + low) // 2
+                try:
+                    db.execute('SELECT 1 WHERE 1 IN ({})'.format(','.join('?' * guess)), [0] * guess)
+                except sqlite3.OperationalError as e:
+                    if 'too many SQL variables' in str(e):
+                        high = guess
+                    else:
+                        raise
+                else:
+                    low = guess
+            _max_sql_variables = low
+        db.close()
+    return _max_sql_variables
+
+
+def great_circle_distance(lat1, lon1, lat2, lon2):
+    """Distance in kilometres between two positions using the haversine formula."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius):
+    """(south, west, north, east) of a box holding every position within `radius` km.
+
+    Boxes crossing a pole or the antimeridian are widened to all longitudes.
+    """
+    angle = radius / EARTH_RADIUS
+    south = latitude - math.degrees(angle)
+    north = latitude + math.degrees(angle)
+    if south <= -90 or north >= 90 or math.sin(angle) >= math.cos(math.radians(latitude)):
+        return max(south, -90), -180, min(north, 90), 180
+    delta = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(latitude))))
+    west, east = longitude - delta, longitude + delta
+    if west < -180 or east > 180:
+        return south, -180, north, 180
+    return south, west, north, east
+
+
+def slugify(name):
+    return re.sub(r'[^\w]+', '-', name.lower())
+
+
+class SlugAllocator(object):
+    """Hand out unique Coordinate slugs for batches of names.
+
+    The base slugs of a batch are checked against the database in bulk and
+    kept in memory, so later batches never need to look them up again.
+    Names that collide get deterministic -2, -3... suffixes.
+    """
+    # Number of base slugs looked up per query, keeps us under SQLite's variable limit
+    LOOKUP_SIZE = 100
+
+    def __init__(self):
+        self.taken = set()
+        self.checked = set()
+        self.next_suffix = {}
+
+    def allocate(self, names):
+        bases = [slugify(name) for name in names]
+        self._load_existing(bases)
+        slugs = []
+        for base in bases:
+            slug = base
+            if slug in self.taken:
+                suffix = self.next_suffix.get(base, 2)
+                while '{}-{}'.format(base, suffix) in self.taken:
+                    suffix += 1
+                slug = '{}-{}'.format(base, suffix)
+                self.next_suffix[base] = suffix + 1
+            self.taken.add(slug)
+            slugs.append(slug)
+        return slugs
+
+    def _load_existing(self, bases):
+        """Fetch the stored slugs that any of `bases` or their suffixed forms could collide with."""
+        unchecked = list(set(bases) - self.checked)
+        self.checked.update(unchecked)
+        for i in range(0, len(unchecked), self.LOOKUP_SIZE):
+            clauses = [(Coordinate.slug == base) | (Coordinate.slug % (base + '-*'))
+                       for base in unchecked[i:i + self.LOOKUP_SIZE]]
+            query = (Coordinate
+                     .select(Coordinate.slug)
+                     .where(NodeList(clauses, ' OR ', parens=True))
+                     .tuples())
+            self.taken.update(slug for slug, in query)
+
 
 class Coordinate(Model):
     latitude = FloatField()
@@ -93,58 +299,79 @@ class Coordinate(Model):
         User,
         backref='coords'
     )
+    # Copy of user.team so team scoped listings need no join, kept in step by TRIGGERS
+    team = ForeignKeyField(
+        Team,
+        null=True,
+        backref='coords'
+    )
 
     class Meta:
         database = DATABASE
+        indexes = (
+            # Newest first listings page on (timestamp, id), the rowid completes the index
+            (('published', 'timestamp'), False),
+            (('team', 'published', 'timestamp'), False),
+        )
+
+    TRIGGERS = (
+        """CREATE TRIGGER IF NOT EXISTS coordinate_team_insert AFTER INSERT ON coordinate
+        WHEN new.team_id IS NULL BEGIN
+            UPDATE coordinate SET team_id = (SELECT team_id FROM "user" WHERE id = new.user_id) WHERE id = new.id;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS coordinate_team_owner AFTER UPDATE OF user_id ON coordinate BEGIN
+            UPDATE coordinate SET team_id = (SELECT team_id FROM "user" WHERE id = new.user_id) WHERE id = new.id;
+        END""",
+    )
+
+    # Moves a user's coordinates along when they change teams
+    USER_TRIGGER = """CREATE TRIGGER IF NOT EXISTS user_team_change AFTER UPDATE OF team_id ON "user"
+        WHEN new.team_id IS NOT old.team_id BEGIN
+            UPDATE coordinate SET team_id = new.team_id WHERE user_id = new.id;
+        END"""
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        super(Coordinate, cls).create_table(safe=safe, **options)
+        for trigger in cls.TRIGGERS:
+            cls._meta.database.execute_sql(trigger)
+        cls.create_user_trigger(cls._meta.database)
+
+    @classmethod
+    def create_user_trigger(cls, database):
+        """Create USER_TRIGGER once both tables exist, called by whichever of them is created last."""
+        if database.table_exists('user') and database.table_exists('coordinate'):
+            database.execute_sql(cls.USER_TRIGGER)
 
     def get_user_coords(self):
         return Coordinate.select().where(Coordinate.user == self)
 
     def get_team_coords(self):
         """Return only the coordinates belonging to the same team as self."""
-        return Coordinate.select().where(
-            (Coordinate.user << User.team_users()) |
-            (Coordinate.user == self)
-        )
+        return Coordinate.select().where(Coordinate.team == self.team_id)
 
     @classmethod
-    def get_coords_without_weather(cls):
-        """Return only coordinates that have no weather data associated with them."""
-        coordinates = (Coordinate
-                       .select()
-                       .join(Weather, JOIN.LEFT_OUTER)
-                       .group_by(Coordinate)
-                       .having(fn.COUNT(Weather.id) == 0))
-        return coordinates
+    def get_coords_without_weather(cls, source=None):
+        """Return only coordinates that have no weather data, or none from `source`, associated with them."""
+        weather = WeatherDay.select(SQL('1')).where(WeatherDay.coordinate == Coordinate.id)
+        if source is not None:
+            weather = weather.where(WeatherDay.source == source)
+        return Coordinate.select().where(~fn.EXISTS(weather))
 
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = re.sub('[^\w]+', '-', self.name.lower())
-        ret = super(Coordinate, self).save(*args, **kwargs)
-
-        # Store search content
-        self.update_search_index()
-        return ret
-
-    def update_search_index(self):
-        try:
-            base_coord = FTSCoord.get(FTSCoord.entry_id == self.id)
-        except FTSCoord.DoesNotExist:
-            base_coord = FTSCoord(entry_id=self.id)
-            force_insert = True
-        else:
-            force_insert = False
-        base_coord.content = '\n'.join((self.name, self.notes))
-        base_coord.save(force_insert=force_insert)
+            self.slug = SlugAllocator().allocate([self.name])[0]
+        if self.team_id is None and self.user_id is not None:
+            self.team_id = self.user.team_id
+        # The search index is updated by the triggers on the coordinate table
+        return super(Coordinate, self).save(*args, **kwargs)
 
     @classmethod
     def private(cls, user):
-        team = user.team
         return (Coordinate
-                .select(Coordinate, User)
-                .join(User)
+                .select()
                 .where(
-            (User.team == team) &
+            (Coordinate.team == user.team_id) &
             (Coordinate.published == False))
                 .order_by(Coordinate.timestamp.desc()))
 
@@ -153,33 +380,548 @@ class Coordinate(Model):
         return Coordinate.select().where(Coordinate.published == True)
 
     @classmethod
-    def search(cls, query):
-        words = [word.strip() for word in query.split() if word.strip()]
-        if not words:
+    def visible(cls, user=None):
+        """Public points, plus the private points of the user's team when a user is given."""
+        if user is None:
+            return cls.public()
+        return Coordinate.select().where(
+            (Coordinate.published == True) |
+            (Coordinate.team == user.team_id))
+
+    @classmethod
+    def within_bbox(cls, south, west, north, east, user=None):
+        """Points visible to `user` inside a bounding box, found through the R*Tree index."""
+        if south > north or west > east:
+            raise ValueError("Bounding box must be given as south <= north and west <= east.")
+        candidates = (CoordinateRTree
+                      .select(CoordinateRTree.id)
+                      .where(
+            (CoordinateRTree.max_lat >= south) &
+            (CoordinateRTree.min_lat <= north) &
+            (CoordinateRTree.max_lon >= west) &
+            (CoordinateRTree.min_lon <= east)))
+        return cls.visible(user).where(
+            (Coordinate.id << candidates) &
+            (Coordinate.latitude.between(south, north)) &
+            (Coordinate.longitude.between(west, east)))
+
+    @classmethod
+    def nearest(cls, latitude, longitude, k=10, user=None, radius=1):
+        """The k points visible to `user` closest to a position.
+
+        Returns (point, distance in km) pairs, nearest first. The R*Tree is
+        searched with a box that grows from `radius` km until it is certain
+        to hold the k nearest points.
+        """
+        while True:
+            south, west, north, east = bounding_box(latitude, longitude, radius)
+            candidates = (cls
+                          .within_bbox(south, west, north, east, user=user)
+                          .select(Coordinate.id, Coordinate.latitude, Coordinate.longitude)
+                          .tuples())
+            ranked = sorted(
+                (great_circle_distance(latitude, longitude, lat, lon), point_id)
+                for point_id, lat, lon in candidates)
+            whole_earth = (south, west, north, east) == (-90, -180, 90, 180)
+            if len(ranked) >= k and ranked[k - 1][0] <= radius or whole_earth:
+                break
+            # The k-th candidate is a safe radius to search again with, otherwise widen quickly
+            radius = ranked[k - 1][0] if len(ranked) >= k else radius * 4
+
+        ranked = ranked[:k]
+        points = {point.id: point for point in
+                  Coordinate.select().where(Coordinate.id << [point_id for _, point_id in ranked])}
+        return [(points[point_id], distance) for distance, point_id in ranked]
+
+    @classmethod
+    def search(cls, query, user=None):
+        """Points visible to `user` matching a search, best match first.
+
+        Every point carries `name_highlight` and `snippet`, HTML-unsafe text
+        with the matched terms wrapped in HIGHLIGHT markers.
+        """
+        match = CoordinateFTS.matching(query, user=user)
+        if match is None:
             # Return empty query
             return Coordinate.select().where(Coordinate.id == 0)
-        else:
-            search = ' '.join(words)
-
-        return (FTSCoord
-                .select(
-            FTSCoord,
-            Coordinate,
-            FTSCoord.rank().alias('score'))
-                .join(Coordinate, on=(FTSCoord.entry_id == Coordinate.id).alias('point'))
-                .where(
-            (Coordinate.published == True) &
-            (FTSCoord.match(search)))
-                .order_by(SQL('score').desc()))
 
+        return (Coordinate
+                .select(Coordinate,
+                        CoordinateFTS.highlight_name().alias('name_highlight'),
+                        CoordinateFTS.snippet().alias('snippet'))
+                .join(CoordinateFTS, on=(CoordinateFTS.rowid == Coordinate.id))
+                .where(match)
+                .order_by(CoordinateFTS.rank()))
+
+    @classmethod
+    def search_ids(cls, query, user=None):
+        """Iterate over the ids of the points visible to `user` matching a search, best match first.
+
+        Read from the index alone, without loading any coordinate.
+        """
+        match = CoordinateFTS.matching(query, user=user)
+        if match is None:
+            return iter(())
+        return (point_id for point_id, in (CoordinateFTS
+                                           .select(CoordinateFTS.rowid)
+                                           .where(match)
+                                           .order_by(CoordinateFTS.rank())
+                                           .tuples()
+                                           .iterator()))
+
+    @classmethod
+    def search_results(cls, query, ids, user=None):
+        """The points among `ids` matching a search, with their highlights, in no particular order.
+
+        Each id is looked up in the index directly instead of ranking every
+        match, for pages of an already ranked list of ids.
+        """
+        return cls.search(query, user=user).where(CoordinateFTS.rowid.in_(ids)).order_by()
+
+    @classmethod
+    def suggest(cls, prefix, user=None, limit=10):
+        """Names of points visible to `user` containing the words typed so far.
+
+        Only the newest SUGGEST_WINDOW matches are looked at, read from the
+        prefix indexed CoordinateNameFTS in newest first rowid order, so the
+        cost doesn't grow with the number of points. Names used most often
+        in that window come first.
+        """
+        expression = suggest_expression(prefix)
+        if not expression:
+            return []
+        newest = (CoordinateNameFTS
+                  .select(CoordinateNameFTS.rowid, CoordinateNameFTS.name)
+                  .where(CoordinateNameFTS.match('name : ({}) AND {}'.format(
+                      expression, CoordinateNameFTS.visible_to(user))))
+                  .order_by(CoordinateNameFTS.rowid.desc())
+                  .limit(SUGGEST_WINDOW))
+        return [name for name, in (CoordinateNameFTS
+                                   .select(newest.c.name)
+                                   .from_(newest)
+                                   .group_by(newest.c.name)
+                                   .order_by(fn.COUNT(SQL('*')).desc(), fn.MAX(newest.c.rowid).desc())
+                                   .limit(limit)
+                                   .tuples())]
+
+
+# Number of newest matches of a typed prefix that name suggestions are drawn from
+SUGGEST_WINDOW = 500
+
+# Start and end of a matched term in search highlights and snippets
+HIGHLIGHT = ('\x02', '\x03')
+
+_search_terms = re.compile(r'"([^"]*)"?|(\S+)')
+
+# Runs of letters and digits, the tokens unicode61 splits text into
+_name_tokens = re.compile(r'[^\W_]+')
 
-# Full Text Search Model
-class FTSCoord(FTSModel):
-    entry_id = IntegerField(Coordinate)
-    content = SearchField()
+
+def normalize_search(search):
+    """Canonical form of a search for cache keys, searches differing only in case and spacing are the same."""
+    return ' '.join((search or '').lower().split())
+
+
+def search_expression(query):
+    """Translate a user's search into an FTS5 query, or None if it holds no terms.
+
+    Words must all match and a word ending in * matches by prefix, "quoted
+    words" match as a phrase. Everything else is quoted so user input can't
+    form FTS5 syntax.
+    """
+    terms = []
+    for phrase, word in _search_terms.findall(query):
+        text = (phrase or word).strip()
+        prefix = not phrase and text.endswith('*')
+        text = text.rstrip('*').replace('"', '')
+        if text.strip():
+            terms.append('"{}"{}'.format(text, ' *' if prefix else ''))
+    return ' '.join(terms) or None
+
+
+def suggest_expression(prefix):
+    """Translate the start of a typed name into an FTS5 query, or None if it holds no terms.
+
+    Every token must match and the last one, still being typed, matches by
+    prefix. Tokens are matched one by one rather than as phrases, which
+    CoordinateNameFTS doesn't support, so 'x-ray' finds 'x' and 'ray'.
+    """
+    tokens = _name_tokens.findall(prefix)
+    if not tokens:
+        return None
+    return ' '.join('"{}"'.format(token) for token in tokens) + ' *'
+
+
+# Full Text Search Models
+class CoordinateIndex(FTS5Model):
+    """Base of the FTS5 indexes of coordinate columns.
+
+    The rowid of an entry is the id of its coordinate. `scope` holds a single
+    token, 'public' or 'team<id>' for private points, so searches only ever
+    score the rows they are allowed to see. Subclasses declare a field per
+    indexed coordinate column, named after it and listed in COLUMNS, then
+    `scope`. Triggers keep the index in step with every write to coordinate,
+    bulk inserts included, and a new index fills itself on creation.
+    """
+    COLUMNS = ()
+
+    # bm25 weights of the columns, None for the default
+    RANK = None
+
+    # Scope of a coordinate row, columns prefixed with 'new.' in triggers
+    SCOPE = "CASE WHEN {row}published THEN 'public' ELSE 'team' || {row}team_id END"
+
+    @classmethod
+    def triggers(cls):
+        """Triggers indexing every write to coordinate.
+
+        Points inserted without a team are indexed once coordinate_team_insert has filled it in.
+        """
+        table = cls._meta.table_name
+        insert = 'INSERT INTO {table} (rowid, {columns}, scope) VALUES (new.id, {values}, {scope});'.format(
+            table=table,
+            columns=', '.join(cls.COLUMNS),
+            values=', '.join('new.' + column for column in cls.COLUMNS),
+            scope=cls.SCOPE.format(row='new.'))
+        return (
+            """CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON coordinate
+            WHEN new.team_id IS NOT NULL BEGIN
+                {insert}
+            END""".format(table=table, insert=insert),
+            """CREATE TRIGGER IF NOT EXISTS {table}_update AFTER UPDATE OF {columns}, published, team_id ON coordinate
+            BEGIN
+                DELETE FROM {table} WHERE rowid = old.id;
+                {insert}
+            END""".format(table=table, columns=', '.join(cls.COLUMNS), insert=insert),
+            """CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON coordinate BEGIN
+                DELETE FROM {table} WHERE rowid = old.id;
+            END""".format(table=table),
+        )
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        populate = not cls.table_exists()
+        super(CoordinateIndex, cls).create_table(safe=safe, **options)
+        if cls.RANK:
+            cls.set_rank(cls.RANK)
+        for trigger in cls.triggers():
+            cls._meta.database.execute_sql(trigger)
+        if populate:
+            cls.rebuild_index()
+
+    @classmethod
+    def visible_to(cls, user=None):
+        """Expression restricting a search to the points visible to `user`."""
+        scopes = ['public']
+        if user is not None and user.team_id:
+            scopes.append('team{}'.format(user.team_id))
+        return 'scope : ({})'.format(' OR '.join(scopes))
+
+    @classmethod
+    def rebuild_index(cls):
+        """Reindex every coordinate with a single INSERT ... SELECT."""
+        columns = [getattr(Coordinate, column) for column in cls.COLUMNS]
+        with cls._meta.database.atomic():
+            cls.delete().execute()
+            cls.insert_from(
+                Coordinate.select(Coordinate.id, *columns, SQL(cls.SCOPE.format(row=''))),
+                [cls.rowid] + [getattr(cls, column) for column in cls.COLUMNS] + [cls.scope]).execute()
+        cls._fts_cmd('optimize')
+
+
+class CoordinateFTS(CoordinateIndex):
+    """FTS5 index of the coordinate names and notes."""
+    name = SearchField()
+    notes = SearchField()
+    scope = SearchField()
 
     class Meta:
         database = DATABASE
+        table_name = 'coordinate_fts'
+        options = {'tokenize': 'unicode61 remove_diacritics 2', 'prefix': '2 3'}
+
+    COLUMNS = ('name', 'notes')
+
+    # Weights of name, notes and scope in the bm25 rank. Ordering by the rank column lets
+    # FTS5 sort the matches itself and compute snippets only for the rows returned.
+    RANK = 'bm25(10.0, 1.0, 0.0)'
+
+    @classmethod
+    def matching(cls, query, user=None):
+        """Condition matching the entries visible to `user` for a search, None if it holds no terms."""
+        expression = search_expression(query)
+        if not expression:
+            return None
+        return cls.match('{{name notes}} : ({}) AND {}'.format(expression, cls.visible_to(user)))
+
+    @classmethod
+    def highlight_name(cls):
+        return fn.highlight(cls._meta.entity, 0, *HIGHLIGHT)
+
+    @classmethod
+    def snippet(cls, tokens=16):
+        """Passage of the notes around the matched terms."""
+        return fn.snippet(cls._meta.entity, 1, HIGHLIGHT[0], HIGHLIGHT[1], '\u2026', tokens)
+
+
+class CoordinateNameFTS(CoordinateIndex):
+    """Prefix index of the coordinate names alone, for search-as-you-type.
+
+    Kept apart from CoordinateFTS so a short prefix only reads the names it
+    matches, with the same scope tokens for visibility.
+    """
+    name = SearchField()
+    scope = SearchField()
+
+    class Meta:
+        database = DATABASE
+        table_name = 'coordinate_name_fts'
+        options = {'tokenize': 'unicode61 remove_diacritics 2', 'prefix': '1 2 3 4', 'detail': 'column'}
+
+    COLUMNS = ('name',)
+
+
+class UploadJob(Model):
+    """An uploaded file queued for ingestion by upload_worker.py."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    # A running job not heard from for this long lost its worker
+    STALE_AFTER = datetime.timedelta(minutes=10)
+
+    path = CharField()
+    publish = BooleanField(default=False)
+    status = CharField(default=QUEUED, index=True)
+    accepted = IntegerField(default=0)
+    rejected = IntegerField(default=0)
+    errors = TextField(null=True)  # JSON list of rejected rows or the failure message
+    created_at = DateTimeField(default=datetime.datetime.now)
+    started_at = DateTimeField(null=True)
+    finished_at = DateTimeField(null=True)
+    heartbeat_at = DateTimeField(null=True)  # Last progress reported by the worker
+    user = ForeignKeyField(
+        User,
+        backref='upload_jobs'
+    )
+
+    class Meta:
+        database = DATABASE
+
+    @classmethod
+    def enqueue(cls, user, path, publish):
+        return cls.create(user=user, path=path, publish=publish)
+
+    @classmethod
+    def claim(cls):
+        """Mark the oldest queued job as running and return it, or None if the queue is empty.
+
+        Several workers may poll at once, the conditional UPDATE makes sure
+        only one of them gets each job.
+        """
+        cls.fail_stale()
+        while True:
+            job = (cls
+                   .select()
+                   .where(cls.status == cls.QUEUED)
+                   .order_by(cls.id)
+                   .first())
+            if job is None:
+                return None
+            now = datetime.datetime.now()
+            claimed = (cls
+                       .update(status=cls.RUNNING, started_at=now, heartbeat_at=now)
+                       .where((cls.id == job.id) & (cls.status == cls.QUEUED))
+                       .execute())
+            if claimed:
+                return cls.get(cls.id == job.id)
+
+    @classmethod
+    def fail_stale(cls):
+        """Fail the running jobs whose worker stopped reporting progress, e.g. because it was killed.
+
+        They aren't queued again as the points of their finished batches are
+        already stored and would be added twice.
+        """
+        return (cls
+                .update(status=cls.FAILED,
+                        finished_at=datetime.datetime.now(),
+                        errors=json.dumps(['The upload was interrupted, only the accepted points were added.']))
+                .where((cls.status == cls.RUNNING) &
+                       (fn.COALESCE(cls.heartbeat_at, cls.started_at) < datetime.datetime.now() - cls.STALE_AFTER))
+                .execute())
+
+    def progress(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'errors': json.loads(self.errors) if self.errors else [],
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class CoordinateRTree(Model):
+    """SQLite R*Tree over coordinate positions, each entry shares the id of its coordinate.
+
+    Kept in sync with the coordinate table by triggers. The R*Tree stores
+    32 bit floats, so its results are candidates to be checked against the
+    exact coordinate values.
+    """
+    id = IntegerField(primary_key=True)
+    min_lat = FloatField()
+    max_lat = FloatField()
+    min_lon = FloatField()
+    max_lon = FloatField()
+
+    class Meta:
+        database = DATABASE
+        table_name = 'coordinate_rtree'
+
+    TRIGGERS = (
+        """CREATE TRIGGER IF NOT EXISTS coordinate_rtree_insert AFTER INSERT ON coordinate BEGIN
+            INSERT INTO coordinate_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS coordinate_rtree_update AFTER UPDATE OF latitude, longitude ON coordinate BEGIN
+            INSERT OR REPLACE INTO coordinate_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS coordinate_rtree_delete AFTER DELETE ON coordinate BEGIN
+            DELETE FROM coordinate_rtree WHERE id = old.id;
+        END""",
+    )
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        populate = not cls.table_exists()
+        cls._meta.database.execute_sql(
+            'CREATE VIRTUAL TABLE {}coordinate_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)'
+            .format('IF NOT EXISTS ' if safe else ''))
+        for trigger in cls.TRIGGERS:
+            cls._meta.database.execute_sql(trigger)
+        if populate:
+            cls.rebuild_index()
+
+    @classmethod
+    def drop_table(cls, safe=True, **options):
+        cls._meta.database.execute_sql('DROP TABLE {}coordinate_rtree'.format('IF EXISTS ' if safe else ''))
+
+    @classmethod
+    def rebuild_index(cls):
+        """Reinsert the position of every coordinate as a zero sized box."""
+        with cls._meta.database.atomic():
+            cls.delete().execute()
+            cls.insert_from(
+                Coordinate.select(
+                    Coordinate.id,
+                    Coordinate.latitude,
+                    Coordinate.latitude,
+                    Coordinate.longitude,
+                    Coordinate.longitude),
+                [cls.id, cls.min_lat, cls.max_lat, cls.min_lon, cls.max_lon]).execute()
+
+
+class DataVersion(Model):
+    """Write counter per table, bumped by triggers on every insert, update and delete.
+
+    Anything derived from the stored coordinates can be keyed on the current
+    version and is stale as soon as it changes.
+    """
+    name = CharField(primary_key=True)
+    version = IntegerField(default=0)
+
+    class Meta:
+        database = DATABASE
+
+    TRIGGERS = tuple(
+        """CREATE TRIGGER IF NOT EXISTS coordinate_version_{0} AFTER {1} ON coordinate BEGIN
+            UPDATE dataversion SET version = version + 1 WHERE name = 'coordinate';
+        END""".format(event.lower(), event)
+        for event in ('INSERT', 'UPDATE', 'DELETE')
+    )
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        super(DataVersion, cls).create_table(safe=safe, **options)
+        cls.insert(name='coordinate').on_conflict_ignore().execute()
+        for trigger in cls.TRIGGERS:
+            cls._meta.database.execute_sql(trigger)
+
+    @classmethod
+    def current(cls, name='coordinate'):
+        return cls.select(cls.version).where(cls.name == name).scalar() or 0
+
+
+class PointCount(Model):
+    """Number of coordinates per team and visibility, kept current by triggers.
+
+    Lets the listings show their totals without counting the coordinate table.
+    Points without a team are counted under team 0. `repair` recounts from
+    scratch should the counters ever drift.
+    """
+    team = IntegerField()
+    published = BooleanField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        database = DATABASE
+        primary_key = CompositeKey('team', 'published')
+
+    TRIGGERS = (
+        """CREATE TRIGGER IF NOT EXISTS pointcount_insert AFTER INSERT ON coordinate BEGIN
+            INSERT OR IGNORE INTO pointcount VALUES (COALESCE(new.team_id, 0), new.published, 0);
+            UPDATE pointcount SET count = count + 1
+            WHERE team = COALESCE(new.team_id, 0) AND published = new.published;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS pointcount_update AFTER UPDATE OF team_id, published ON coordinate
+        WHEN new.team_id IS NOT old.team_id OR new.published IS NOT old.published BEGIN
+            UPDATE pointcount SET count = count - 1
+            WHERE team = COALESCE(old.team_id, 0) AND published = old.published;
+            INSERT OR IGNORE INTO pointcount VALUES (COALESCE(new.team_id, 0), new.published, 0);
+            UPDATE pointcount SET count = count + 1
+            WHERE team = COALESCE(new.team_id, 0) AND published = new.published;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS pointcount_delete AFTER DELETE ON coordinate BEGIN
+            UPDATE pointcount SET count = count - 1
+            WHERE team = COALESCE(old.team_id, 0) AND published = old.published;
+        END""",
+    )
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        populate = not cls.table_exists()
+        super(PointCount, cls).create_table(safe=safe, **options)
+        for trigger in cls.TRIGGERS:
+            cls._meta.database.execute_sql(trigger)
+        if populate:
+            cls.repair()
+
+    @classmethod
+    def repair(cls):
+        """Recount every team's points with a single INSERT ... SELECT."""
+        team = fn.COALESCE(Coordinate.team, 0)
+        with cls._meta.database.atomic():
+            cls.delete().execute()
+            cls.insert_from(
+                Coordinate.select(team, Coordinate.published, fn.COUNT(Coordinate.id))
+                .group_by(team, Coordinate.published),
+                [cls.team, cls.published, cls.count]).execute()
+
+    @classmethod
+    def public(cls):
+        """Number of published points."""
+        return cls.select(fn.SUM(cls.count)).where(cls.published == True).scalar() or 0
+
+    @classmethod
+    def private(cls, user):
+        """Number of unpublished points of the user's team."""
+        return (cls
+                .select(cls.count)
+                .where((cls.team == (user.team_id or 0)) & (cls.published == False))
+                .scalar()) or 0
 
 
 class Visit(Model):
@@ -193,8 +935,68 @@ class Visit(Model):
         database = DATABASE
 
 
+class WeatherDay(Model):
+    """Weather of a point on one day, from a forecast `lead_days` ahead or from historical data.
+
+    Rows are stored in primary key order, which leads with (coordinate,
+    valid_date), so the weather of a point over a range of days is a single
+    range scan and there is no separate index to keep. A forecast for the
+    same point, day and lead time replaces the stored one.
+    """
+    FORECAST = 'forecast'
+    DAYMET = 'daymet'
+
+    coordinate = ForeignKeyField(
+        Coordinate,
+        backref='weather',
+        index=False  # Covered by the primary key
+    )
+    valid_date = DateField()
+    lead_days = IntegerField(default=0)  # 0 for today's forecast and for historical data
+    source = CharField()
+    summary = TextField(null=True)  # Summary of the forecast week, on its first day
+    precip_intensity_max = FloatField(null=True)
+    precip = FloatField(null=True)  # Precipitation accumulation
+    tmin = FloatField(null=True)
+    tmax = FloatField(null=True)
+
+    class Meta:
+        database = DATABASE
+        primary_key = CompositeKey('coordinate', 'valid_date', 'source', 'lead_days')
+        without_rowid = True
+
+    @staticmethod
+    def day_of(timestamp):
+        """Date of the midnight closest to a Unix time, e.g. the local midnight a daily forecast is given at."""
+        return datetime.datetime.utcfromtimestamp(timestamp + 12 * 60 * 60).date()
+
+    @classmethod
+    def upsert(cls, rows):
+        """Write rows of every column, in declaration order with dates as 'YYYY-MM-DD', in one transaction.
+
+        Rows replace any stored for the same point, day, source and lead time.
+        The statement is compiled once and run for every row by executemany,
+        building multi-row INSERTs with peewee costs several times more than
+        writing them.
+        """
+        if not rows:
+            return
+        columns = cls._meta.sorted_fields
+        sql, _ = (cls
+                  .insert_many(rows[:1], fields=columns)
+                  .on_conflict(conflict_target=[cls.coordinate, cls.valid_date, cls.source, cls.lead_days],
+                               preserve=[cls.summary, cls.precip_intensity_max, cls.precip, cls.tmin, cls.tmax])
+                  .sql())
+        with cls._meta.database.atomic():
+            cls._meta.database.cursor().executemany(sql, rows)
+
+
 class Weather(Model):
-    """Model for weather data."""
+    """Read-only view of WeatherDay in the wide layout of earlier versions.
+
+    Has a row per point and forecast, or per point and day of historical
+    data. The ft_N_time columns are UTC midnight of each day.
+    """
 
     # Summary of the day as a whole using averages
     day_summary = TextField(null=True)
@@ -255,16 +1057,82 @@ class Weather(Model):
     ft_7_temp_min = FloatField(null=True)
     ft_7_temp_max = FloatField(null=True)
 
-    coordinate = ForeignKeyField(
-        Coordinate,
-        backref='forecasts'
-    )
+    # Not a foreign key, so deleting a coordinate doesn't try to delete from the view
+    coordinate = IntegerField(column_name='coordinate_id')
 
     class Meta:
         database = DATABASE
+        primary_key = False
+
+    VIEW = """CREATE VIEW {{}}weather AS SELECT
+        MAX(CASE WHEN lead_days = 0 THEN summary END) AS day_summary,
+        {},
+        coordinate_id
+    FROM weatherday
+    GROUP BY coordinate_id, source, date(valid_date, '-' || lead_days || ' days')""".format(',\n        '.join(
+        'MAX(CASE WHEN lead_days = {0} THEN {1} END) AS ft_{0}_{2}'.format(day, column, name)
+        for day in range(8)
+        for column, name in (("CAST(strftime('%s', valid_date) AS INTEGER)", 'time'),
+                             ('precip_intensity_max', 'precip_intensity_max'),
+                             ('precip', 'precip_accumulation'),
+                             ('tmin', 'temp_min'),
+                             ('tmax', 'temp_max'))))
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        cls._meta.database.execute_sql(cls.VIEW.format('IF NOT EXISTS ' if safe else ''))
+
+    @classmethod
+    def drop_table(cls, safe=True, **options):
+        cls._meta.database.execute_sql('DROP VIEW {}weather'.format('IF EXISTS ' if safe else ''))
+
+
+class CellForecast(Model):
+    """Forecast API response for a grid cell, shared by every point in the cell.
+
+    Responses are kept per forecast issue so reruns within the same issue
+    period reuse them instead of calling the API again.
+    """
+    latitude = FloatField()
+    longitude = FloatField()
+    issued = IntegerField(index=True)  # Unix time the forecast period started
+    data = TextField()  # JSON response
+
+    class Meta:
+        database = DATABASE
+        primary_key = CompositeKey('latitude', 'longitude', 'issued')
+
+    @classmethod
+    def cached(cls, issued):
+        """{(latitude, longitude): decoded response} of the cells fetched for an issue."""
+        return {(latitude, longitude): json.loads(data)
+                for latitude, longitude, data in (cls
+                                                  .select(cls.latitude, cls.longitude, cls.data)
+                                                  .where(cls.issued == issued)
+                                                  .tuples())}
+
+    @classmethod
+    def store(cls, responses, issued):
+        """Cache ((latitude, longitude), decoded response) pairs fetched for an issue."""
+        rows = [(latitude, longitude, issued, json.dumps(data)) for (latitude, longitude), data in responses]
+        size = max_sql_variables() // 4
+        for start in range(0, len(rows), size):
+            cls.replace_many(rows[start:start + size],
+                             fields=[cls.latitude, cls.longitude, cls.issued, cls.data]).execute()
+
+    @classmethod
+    def prune(cls, issued):
+        """Remove the responses of issues older than `issued`."""
+        return cls.delete().where(cls.issued < issued).execute()
 
 
 def initialize():
+    import migrations  # Imports this module
     DATABASE.connect()
-    DATABASE.create_tables([Team, User, Coordinate, FTSCoord, Weather, Visit], safe=True)
+    migrations.upgrade(DATABASE)
+    DATABASE.create_tables([Team, User, Coordinate, CoordinateFTS, CoordinateNameFTS, CoordinateRTree, DataVersion,
+                            PointCount, WeatherDay, Weather, CellForecast, Visit, UploadJob], safe=True)
     DATABASE.close()
+    # Don't keep the connection in the pool, processes forked after this (gunicorn --preload,
+    # upload workers) must not share the parent's sqlite handle
+    DATABASE.close_all()
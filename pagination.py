@@ -0,0 +1,119 @@
+"""
+Pagination for the coordinate listings.
+
+Timestamp ordered listings are paged by cursor: the opaque next/previous
+tokens hold the (timestamp, id) of the row a page starts after, so any page
+costs the same as the first. Search results, which are ordered by rank,
+are paged by offset into a cached list of ids, which also gives their total.
+Cursor paged listings never count the whole result set.
+"""
+import base64
+import json
+
+from flask import render_template, request
+from peewee import Tuple
+
+from models import Coordinate
+
+PAGINATE_BY = 20
+
+
+def encode_cursor(point):
+    return base64.urlsafe_b64encode(json.dumps([str(point.timestamp), point.id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    """Return the (timestamp, id) held by a token, or None if it can't be read."""
+    try:
+        timestamp, point_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        return str(timestamp), int(point_id)
+    except (ValueError, TypeError):
+        return None
+
+
+class KeysetPagination(object):
+    """Newest first page of a coordinate query, starting after or before a cursor."""
+
+    def __init__(self, query, paginate_by=PAGINATE_BY, after=None, before=None, total=None):
+        self.paginate_by = paginate_by
+        self.total = total
+        key = Tuple(Coordinate.timestamp, Coordinate.id)
+        after = decode_cursor(after) if after else None
+        before = decode_cursor(before) if before else None
+
+        if before:
+            rows = list(query
+                        .where(key > Tuple(*before))
+                        .order_by(Coordinate.timestamp.asc(), Coordinate.id.asc())
+                        .limit(paginate_by + 1))
+            self._has_previous = len(rows) > paginate_by
+            self._has_next = True
+            self.items = list(reversed(rows[:paginate_by]))
+        else:
+            if after:
+                query = query.where(key < Tuple(*after))
+            rows = list(query
+                        .order_by(Coordinate.timestamp.desc(), Coordinate.id.desc())
+                        .limit(paginate_by + 1))
+            self._has_previous = after is not None
+            self._has_next = len(rows) > paginate_by
+            self.items = rows[:paginate_by]
+
+    def has_previous(self):
+        return self._has_previous and bool(self.items)
+
+    def has_next(self):
+        return self._has_next and bool(self.items)
+
+    def previous_args(self):
+        return {'before': encode_cursor(self.items[0])}
+
+    def next_args(self):
+        return {'after': encode_cursor(self.items[-1])}
+
+
+class IdListPagination(object):
+    """Page of an ordered list of ids, e.g. cached search results.
+
+    `load` is called with the ids of the page and returns their rows in any
+    order. The total is known for free.
+    """
+
+    def __init__(self, ids, load, paginate_by=PAGINATE_BY, page=1):
+        self.paginate_by = paginate_by
+        self.total = len(ids)
+        self.page = max(page, 1)
+        start = (self.page - 1) * paginate_by
+        page_ids = list(ids[start:start + paginate_by])
+        self._has_next = len(ids) > start + paginate_by
+        rows = dict((row.id, row) for row in load(page_ids)) if page_ids else {}
+        self.items = [rows[row_id] for row_id in page_ids if row_id in rows]
+
+    def has_previous(self):
+        return self.page > 1
+
+    def has_next(self):
+        return self._has_next
+
+    def previous_args(self):
+        return {'page': self.page - 1}
+
+    def next_args(self):
+        return {'page': self.page + 1}
+
+
+def keyset_list(template_name, query, context_variable='object_list', total=None, **kwargs):
+    """Render a page of a coordinate query like playhouse.flask_utils.object_list, by cursor."""
+    pagination = KeysetPagination(query,
+                                  after=request.args.get('after'),
+                                  before=request.args.get('before'),
+                                  total=total)
+    kwargs[context_variable] = pagination.items
+    return render_template(template_name, pagination=pagination, **kwargs)
+
+
+def id_list(template_name, ids, load, context_variable='object_list', **kwargs):
+    """Render a page of an ordered list of ids by page number."""
+    pagination = IdListPagination(ids, load, page=request.args.get('page', 1, type=int))
+    kwargs[context_variable] = pagination.items
+    return render_template(template_name, pagination=pagination, **kwargs)
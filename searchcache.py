@@ -0,0 +1,71 @@
+"""
+In-memory cache of ranked search results.
+
+Ranking a search scores every visible match, so the ordered ids of recent
+searches are kept per process and pages are loaded from them. Entries are
+tagged with the coordinate DataVersion they were ranked at: any insert,
+edit, delete or upload bumps it and makes every older entry unreachable,
+in this process and every other.
+"""
+import array
+import collections
+import threading
+
+import models
+
+# Upper bound on the number of ids held across all entries
+MAX_IDS = 1000000
+
+
+class SearchCache(object):
+    """Ordered ids of search results keyed on the normalized search and the scope it was run in.
+
+    The least recently used entries are dropped once more than `max_ids` ids
+    are held, searches with more results than that are never cached.
+    """
+
+    def __init__(self, max_ids=MAX_IDS):
+        self.max_ids = max_ids
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def scope(user=None):
+        """Name of the set of points visible to `user`."""
+        if user is not None and user.team_id:
+            return 'team{}'.format(user.team_id)
+        return 'public'
+
+    def ids(self, search, user=None):
+        """Ids of the points visible to `user` matching a search, best match first."""
+        key = (models.normalize_search(search), self.scope(user))
+        version = models.DataVersion.current()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        ids = array.array('q', models.Coordinate.search_ids(search, user=user))
+        if len(ids) <= self.max_ids:
+            self.store(key, version, ids)
+        return ids
+
+    def store(self, key, version, ids):
+        with self._lock:
+            # Entries of any other version are stale, or about to be
+            for stale in [other for other, (entry_version, _) in self._entries.items() if entry_version != version]:
+                self._size -= len(self._entries.pop(stale)[1])
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key)[1])
+            self._entries[key] = (version, ids)
+            self._size += len(ids)
+            while self._size > self.max_ids:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
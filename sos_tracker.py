@@ -7,29 +7,33 @@ native plant populations over a large area.
 
 Author can be reached at ctsadmin@conservationtechnologysolutions.org
 """
-import csv
 import datetime
 import functools
+import hashlib
+import json
+import mimetypes
 import os
-import random
-import re
 import tempfile
 import timeit
-import xml.etree.ElementTree as ET
+import uuid
 
-from flask import (Flask, flash, g, redirect, render_template, request, Response,
-                   send_from_directory, session, url_for)
+from flask import (Flask, escape, flash, g, jsonify, make_response, Markup, redirect, render_template, request,
+                   Response, send_from_directory, session, url_for)
 from flask_bcrypt import check_password_hash
 from flask_googlemaps import GoogleMaps, Map
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from openpyxl import Workbook
 from peewee import *
-from playhouse.flask_utils import get_object_or_404, object_list
+from playhouse.flask_utils import get_object_or_404
 from urllib.parse import urlencode
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
 
+import build_assets
+import exports
 import forms
 import models
+import searchcache
+from pagination import id_list, keyset_list
 
 print("[*] Initializing the database tables...")
 models.initialize()
@@ -41,6 +45,11 @@ app.config.from_envvar('SOS_TRACKER_SETTINGS')
 
 GoogleMaps(app)
 
+search_cache = searchcache.SearchCache(app.config.get('SEARCH_CACHE_SIZE', searchcache.MAX_IDS))
+
+# Fingerprinted static files, written by build_assets.py
+asset_manifest = build_assets.load_manifest()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.long_view = 'login'
@@ -48,25 +57,41 @@ login_manager.long_view = 'login'
 
 @login_manager.user_loader
 def load_user(userid):
+    """Called once per request, the user and their team come from the process wide identity cache."""
     try:
-        return models.User.get(models.User.id == userid)
-    except models.DoesNotExist:
+        return models.IDENTITIES.get(int(userid))
+    except (models.DoesNotExist, ValueError):
         return None
 
 
 @app.before_request
 def before_request():
-    """Connect to the database before each request."""
-    g.db = models.DATABASE
-    g.db.connect()
+    """The database connects on first use, requests that never query it don't take a connection."""
     g.user = current_user
 
 
-@app.after_request
-def after_request(response):
-    """Close the database connection after each request."""
-    g.db.close()
-    return response
+@app.teardown_request
+def teardown_request(exc):
+    """Return the request's database connection, if it opened one, to the pool."""
+    if not models.DATABASE.is_closed():
+        models.DATABASE.close()
+
+
+@app.cli.command('rebuild-index')
+def rebuild_index():
+    """Rebuild the full-text search and spatial indexes from the coordinate table."""
+    models.CoordinateFTS.rebuild_index()
+    models.CoordinateNameFTS.rebuild_index()
+    print("[*] Search index rebuilt.")
+    models.CoordinateRTree.rebuild_index()
+    print("[*] Spatial index rebuilt.")
+
+
+@app.cli.command('repair-counts')
+def repair_counts():
+    """Recount the points per team behind the listing totals."""
+    models.PointCount.repair()
+    print("[*] Point counts repaired.")
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -117,113 +142,132 @@ def logout():
     return render_template('logout.html')
 
 
-# Parse file into list of coordinates
-def parse_file(filename, publish):
-    file = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    parsed = []
-    user = models.User.get(models.User.username == g.user._get_current_object().username)
-    if filename[-3:] == 'txt':
-        with open(file, 'r') as f:
-            csv_input = csv.reader(f)
-
-            for line in csv_input:
-                # To avoid index out of bound errors
-                if len(line) >= 4:
-                    slug = re.sub('[^\w]+', '-', line[2].lower())
-                    if any(point['slug'] == slug for point in parsed):
-                        # The idea here is to create a 1 in 1000 chance of collision for each subsequent non-unique
-                        # name the slugs are being generated from
-                        slug = slug + str(random.randint(0, 999))
-                    coordinate = {'user': user,
-                                  'latitude': line[0],
-                                  'longitude': line[1],
-                                  'name': line[2],
-                                  'pin': line[3],
-                                  'notes': 'Uploaded from file.',
-                                  'published': publish,
-                                  'slug': slug
-                                  }
-                    parsed.append(coordinate)
-
-    elif filename[-3:] == 'gpx':
-        tree = ET.parse(file)
-        root = tree.getroot()
-        for child in root:
-            if child.tag[-3:] == 'wpt':
-                lat = child.attrib['lat']
-                lon = child.attrib['lon']
-                name = None
-                pin = None
-                for tag in child:
-                    if tag.tag[-4:] == 'name':
-                        name = tag.text
-                    elif tag.tag[-3:] == 'sym':
-                        pin = tag.text
-
-                if name and pin:
-                    slug = re.sub('[^\w]+', '-', name.lower())
-                    if any(point['slug'] == slug for point in parsed):
-                        # The idea here is to create a 1 in 1000 chance of collision for each subsequent non-unique
-                        # name the slugs are being generated from
-                        slug = slug + str(random.randint(0, 999))
-                    coordinate = {'user': user,
-                                  'latitude': lat,
-                                  'longitude': lon,
-                                  'name': name,
-                                  'pin': pin,
-                                  'notes': 'Uploaded from file.',
-                                  'published': publish,
-                                  'slug': slug
-                                  }
-                    parsed.append(coordinate)
-    return parsed
-
-
-# Database expects parsed data
-# data is a list of coordinate dictionaries
-def save_to_database(data):
-    error = 0
-    with models.DATABASE.atomic():
+def export_cache():
+    return exports.ExportCache(
+        app.config.get('EXPORT_CACHE_FOLDER', os.path.join(tempfile.gettempdir(), 'sos_tracker_exports')),
+        app.config.get('EXPORT_CACHE_SIZE', 512 * 1024 * 1024))
+
+
+def stream_export(chunks):
+    """Stream export chunks, releasing the database connection they reopen once done.
+
+    The body is generated after the request has been torn down.
+    """
+    def generate():
         try:
-            models.Coordinate.insert_many(data).execute()
-        except IntegrityError as e:
-            error += 1
-            print(e.args)
-    if error > 0:
-        flash('{} point(s) were not able to be added. Point names must be unique.'.format(error), 'danger')
-
-
-def write_workbook(query, filename, search):
-    """Create ArcGIS compatible xls file using openpyxl."""
-    wb = Workbook()
-    ws = wb.active
-    ws['A1'] = 'Latitude'
-    ws['B1'] = 'Longitude'
-    ws['C1'] = 'Name'
-    ws['D1'] = 'Pin'
-    ws['E1'] = 'Notes'
-    for idx, point in enumerate(query, 2):
-        if search:
-            point = point.point
-        ws['A' + str(idx)] = point.latitude
-        ws['B' + str(idx)] = point.longitude
-        ws['C' + str(idx)] = point.name
-        ws['D' + str(idx)] = point.pin
-        ws['E' + str(idx)] = point.notes
-
-    return wb
+            for chunk in chunks:
+                yield chunk
+        finally:
+            if not models.DATABASE.is_closed():
+                models.DATABASE.close()
+    return generate()
+
+
+def search_list(template_name, search_query, **kwargs):
+    """Render a page of public search results from the cached ranking of their ids."""
+    return id_list(template_name, search_cache.ids(search_query),
+                   lambda ids: models.Coordinate.search_results(search_query, ids), **kwargs)
+
+
+def current_viewer():
+    """The logged in user, or None for anonymous visitors."""
+    if current_user.is_authenticated:
+        return current_user._get_current_object()
+    return None
+
+
+def point_features(points):
+    return {
+        'type': 'FeatureCollection',
+        'features': [exports.feature(point.latitude, point.longitude,
+                                     name=point.name, pin=point.pin, slug=point.slug,
+                                     published=point.published)
+                     for point in points],
+    }
+
+
+def conditional(validator, last_modified=None, private=False, max_age=0):
+    """Answer conditional GETs of a view with 304 Not Modified before rendering it.
+
+    `validator` is called with the view's arguments and returns what the page
+    depends on besides the viewer and the query string, or None to always
+    render it. `last_modified`, if given, returns the modification time. Pages
+    that are public to anonymous visitors are still private once logged in,
+    the navigation shows who is.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pending flashed messages are shown once by the next page rendered
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return view(*args, **kwargs)
+            parts = validator(*args, **kwargs)
+            if parts is None:
+                return view(*args, **kwargs)
+            etag = hashlib.sha1(json.dumps(
+                [current_user.get_id(), request.full_path] + [str(part) for part in parts]).encode('utf-8')).hexdigest()
+            modified = last_modified(*args, **kwargs) if last_modified else None
+
+            if is_resource_modified(request.environ, etag=etag, last_modified=modified):
+                response = make_response(view(*args, **kwargs))
+            else:
+                response = Response(status=304)
+            response.set_etag(etag)
+            if modified:
+                response.last_modified = modified
+            if private or current_user.is_authenticated:
+                response.cache_control.private = True
+            else:
+                response.cache_control.public = True
+            if max_age:
+                response.cache_control.max_age = max_age
+            else:
+                response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+
+def data_version(*args, **kwargs):
+    """Validator for pages built from the coordinates as a whole."""
+    return [models.DataVersion.current()]
+
+
+def team_version(*args, **kwargs):
+    """Validator for pages built from the coordinates of the viewer's team."""
+    return [models.DataVersion.current(), current_user.team_id]
+
+
+def point_version(slug):
+    """Validator for the page of a single point."""
+    point = models.Coordinate.get_or_none(models.Coordinate.slug == slug)
+    if point is None:
+        return None
+    return [point.timestamp] + sorted(point.__data__.items())
+
+
+def upload_files():
+    """Names and modification times of the uploaded files."""
+    return sorted((entry.name, entry.stat().st_mtime) for entry in os.scandir(app.config['UPLOAD_FOLDER'])
+                  if entry.name != '.gitignore')
+
+
+def upload_folder_modified():
+    folder = app.config['UPLOAD_FOLDER']
+    mtime = max([os.stat(folder).st_mtime] + [mtime for _, mtime in upload_files()])
+    return datetime.datetime.utcfromtimestamp(int(mtime))
 
 
 # Views
 # Main landing page
 @app.route('/')
+@conditional(data_version)
 def index():
     search_query = request.args.get('q')
     if search_query:
-        query = models.Coordinate.search(search_query)
-    else:
-        query = models.Coordinate.public().order_by(models.Coordinate.timestamp.desc())
-    return object_list('index.html', query, search=search_query, check_bounds=False)
+        return search_list('index.html', search_query, search=search_query)
+    return keyset_list('index.html', models.Coordinate.public(), total=models.PointCount.public())
 
 
 # Manually create a single GPS point
@@ -232,7 +276,7 @@ def index():
 def create():
     form = forms.CreateCoordForm()
     if form.validate_on_submit():
-        user = models.User.get(models.User.username == g.user._get_current_object().username)
+        user = current_user._get_current_object()
         point = models.Coordinate.create(
             user=user,
             latitude=form.latitude.data,
@@ -254,37 +298,86 @@ def download():
     search_query = request.args.get('dq') or request.form.get('prev-search')
     if search_query:
         query = models.Coordinate.search(search_query)
-        search = True
     else:
-        query = models.Coordinate.public().order_by(models.Coordinate.timestamp.desc())
-        search = False
+        # Newest first for the exports, the listing pages by the same order
+        query = models.Coordinate.public().order_by(models.Coordinate.timestamp.desc(), models.Coordinate.id.desc())
     if request.method == 'POST':
         if request.form.get('filename'):
-            filename = secure_filename(request.form.get('filename')) + '.xls'
-            wb = write_workbook(query, filename, search)
+            fmt = request.form.get('format')
+            if fmt not in exports.FORMATS:
+                fmt = 'xls'
+            extension, mimetype, exporter = exports.FORMATS[fmt]
+            filename = secure_filename(request.form.get('filename')) + extension
             if request.form.get('save'):
-                wb.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as f:
+                    for chunk in exporter(query):
+                        f.write(chunk)
                 flash('Search added to files successfully!', 'success')
                 return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
             else:
-                temp = tempfile.TemporaryDirectory()
-                wb.save(temp.name + '/' + filename)
-                return send_from_directory(temp.name, filename, as_attachment=True)
+                version = models.DataVersion.current()
+                cache = export_cache()
+                cached = cache.get(search_query, fmt, version)
+                if cached:
+                    chunks = exports.iter_file(cached)
+                else:
+                    chunks = cache.store(search_query, fmt, version, exporter(query))
+                return Response(stream_export(chunks), mimetype=mimetype,
+                                headers={'Content-Disposition': 'attachment; filename=' + filename})
         else:
             flash('Please specify a search name.', 'danger')
-    return object_list('download.html', query, dsearch=search_query, check_bounds=False)
+    if search_query:
+        return search_list('download.html', search_query, dsearch=search_query)
+    return keyset_list('download.html', query, total=models.PointCount.public())
 
 
 # View private points visible only to that user and that user's team
 @app.route('/private')
 @login_required
+@conditional(team_version, private=True)
 def private():
-    user = models.User.get(models.User.username == g.user._get_current_object().username)
-    query = models.Coordinate.private(user)
-    return object_list('index.html', query, check_bounds=False)
+    user = current_user._get_current_object()
+    return keyset_list('index.html', models.Coordinate.private(user), total=models.PointCount.private(user))
+
+
+# Points inside a bounding box as GeoJSON
+@app.route('/api/points')
+def api_points():
+    try:
+        west, south, east, north = [float(part) for part in request.args.get('bbox', '').split(',')]
+        query = models.Coordinate.within_bbox(south, west, north, east, user=current_viewer())
+    except ValueError:
+        return jsonify({'error': "bbox must be given as 'west,south,east,north'."}), 400
+    limit = max(1, min(request.args.get('limit', 1000, type=int), 10000))
+    return jsonify(point_features(query.limit(limit)))
+
+
+# The visible points closest to a position as GeoJSON, nearest first
+@app.route('/api/nearest')
+def api_nearest():
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    if latitude is None or longitude is None or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        return jsonify({'error': "'lat' and 'lon' must be given in decimal degrees."}), 400
+    k = max(1, min(request.args.get('k', 10, type=int), 100))
+    nearest = models.Coordinate.nearest(latitude, longitude, k=k, user=current_viewer())
+    collection = point_features(point for point, _ in nearest)
+    for feature, (_, distance) in zip(collection['features'], nearest):
+        feature['properties']['distance_km'] = round(distance, 3)
+    return jsonify(collection)
+
+
+# Point names starting with the words typed so far, for search-as-you-type
+@app.route('/api/suggest')
+def api_suggest():
+    prefix = request.args.get('prefix', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    return jsonify({'prefix': prefix,
+                    'suggestions': models.Coordinate.suggest(prefix, user=current_viewer(), limit=limit)})
 
 
 @app.route('/<slug>')
+@conditional(point_version)
 def detail(slug):
     if current_user.is_authenticated:
         query = models.Coordinate.select()
@@ -331,6 +424,21 @@ def edit(slug):
     return render_template('edit.html', point=point)
 
 
+@app.template_global()
+def asset_url(filename):
+    """URL of the fingerprinted build of a static file, or of the file itself if it hasn't been built."""
+    if filename in asset_manifest:
+        return url_for('asset', filename=asset_manifest[filename])
+    return url_for('static', filename=filename)
+
+
+@app.template_filter('highlight')
+def highlight(text):
+    """Escape a search highlight or snippet and mark up its matched terms."""
+    start, end = models.HIGHLIGHT
+    return Markup(escape(text or '').replace(start, Markup('<mark>')).replace(end, Markup('</mark>')))
+
+
 # From peewee blog example
 # http://charlesleifer.com/blog/how-to-make-a-flask-blog-in-one-hour-or-less/
 @app.template_filter('clean_querystring')
@@ -344,9 +452,9 @@ def clean_querystring(request_args, *keys_to_remove, **new_values):
 
 # View list of uploaded files
 @app.route('/files')
+@conditional(upload_files, last_modified=upload_folder_modified, max_age=60)
 def list_files():
-    files = os.listdir(app.config['UPLOAD_FOLDER'])
-    files.remove('.gitignore')
+    files = [name for name, _ in upload_files()]
     return render_template('files.html', files=files)
 
 
@@ -364,14 +472,43 @@ def upload():
         filename = secure_filename(form.file.data.filename)
         # If publish is true, the point is considered Public
         publish = form.publish.data
-        form.file.data.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        data = parse_file(filename, publish)
-        save_to_database(data)
-        flash('File uploaded successfully!', 'success')
+        # A unique prefix keeps a later upload of the same name from replacing a file still queued
+        path = os.path.join(app.config['UPLOAD_FOLDER'], '{}-{}'.format(uuid.uuid4().hex[:12], filename))
+        form.file.data.save(path)
+        user = current_user._get_current_object()
+        job = models.UploadJob.enqueue(user, path, publish)
+        flash('File uploaded successfully! Its points are being added in the background, '
+              'progress can be followed at {}'.format(url_for('upload_status', job_id=job.id)), 'success')
         return redirect(url_for('index'))
     return render_template('upload.html', form=form)
 
 
+# Progress of a queued upload, only shown to the user who uploaded it
+@app.route('/upload/<int:job_id>/status')
+@login_required
+def upload_status(job_id):
+    job = get_object_or_404(models.UploadJob,
+                            (models.UploadJob.id == job_id) & (models.UploadJob.user == current_user.id))
+    return jsonify(job.progress())
+
+
+# Fingerprinted static files never change, a client only ever downloads them once
+@app.route('/static/dist/<path:filename>')
+def asset(filename):
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, extension in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and os.path.isfile(
+                os.path.join(build_assets.DIST_FOLDER, filename + extension)):
+            response = send_from_directory(build_assets.DIST_FOLDER, filename + extension, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(build_assets.DIST_FOLDER, filename, mimetype=mimetype)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 # View file
 @app.route('/upload/<filename>')
 def uploaded(filename):
@@ -0,0 +1,27 @@
+// Offer point names matching the search box as it is typed.
+$(function () {
+	var input = $('#search-form input[name="q"]');
+	var list = $('#search-suggestions');
+	var timer = null;
+	var request = null;
+
+	input.on('input', function () {
+		clearTimeout(timer);
+		timer = setTimeout(function () {
+			var prefix = $.trim(input.val());
+			if (request) {
+				request.abort();
+			}
+			if (!prefix) {
+				list.empty();
+				return;
+			}
+			request = $.getJSON(input.data('suggest-url'), {prefix: prefix}, function (data) {
+				list.empty();
+				$.each(data.suggestions, function (i, name) {
+					list.append($('<option>').attr('value', name));
+				});
+			});
+		}, 150);
+	});
+});
@@ -0,0 +1,83 @@
+"""
+Parse and load queued uploads in the background.
+
+The web app only stores uploaded files and queues an UploadJob for them, this
+script does the actual ingestion. Run it next to the web app:
+
+    python upload_worker.py --workers 4
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import time
+import traceback
+
+import ingest
+import models
+
+# Seconds to wait before checking an empty queue again
+POLL_INTERVAL = 2
+
+# Number of rejected rows kept on the job for the status endpoint
+MAX_REPORTED_ERRORS = 100
+
+
+def run_job(job):
+    """Ingest the file of a claimed job, recording progress as batches are written."""
+    def progress(report):
+        job.accepted = report.accepted
+        job.rejected = len(report.rejected)
+        job.heartbeat_at = datetime.datetime.now()
+        job.save(only=[models.UploadJob.accepted, models.UploadJob.rejected, models.UploadJob.heartbeat_at])
+
+    try:
+        report = ingest.save_to_database(ingest.parse_file(job.path, job.user, job.publish),
+                                         progress=progress)
+    except Exception as e:
+        traceback.print_exc()
+        job.status = models.UploadJob.FAILED
+        job.errors = json.dumps([str(e)])
+    else:
+        job.status = models.UploadJob.DONE
+        job.errors = json.dumps([
+            {'row': row, 'name': name, 'reason': reason}
+            for row, name, reason in report.rejected[:MAX_REPORTED_ERRORS]
+        ])
+    job.finished_at = datetime.datetime.now()
+    job.save()
+
+
+def work(once=False):
+    """Process jobs until the queue is empty (`once`) or forever."""
+    while True:
+        job = models.UploadJob.claim()
+        if job is None:
+            if once:
+                return
+            time.sleep(POLL_INTERVAL)
+            continue
+        print("[*] Processing upload job {} ({})".format(job.id, job.path))
+        run_job(job)
+        print("[*] Job {} {}: {} accepted, {} rejected".format(job.id, job.status, job.accepted, job.rejected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+    args = parser.parse_args()
+
+    models.initialize()
+    if args.workers == 1:
+        work(args.once)
+        return
+    processes = [multiprocessing.Process(target=work, args=(args.once,)) for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,154 +3,276 @@
 """
 Query database for coordinates and update weather data for each point.
 
-To be run periodically as a cron job.
+To be run periodically as a cron job. Points are grouped into grid cells and
+one forecast is fetched per cell for every point in it. Forecasts are fetched
+concurrently, rate limited to stay within the API quota and retried with
+exponential backoff, so a slow or failing request never stalls the whole run.
+Responses are kept per forecast issue, so a rerun within the same issue
+period only fetches the cells that are still missing.
+
+The API can be pointed at a local stand-in server through
+SOS_FORECAST_API_URL, e.g. for tests and benchmarks.
 """
+import argparse
+import collections
+import concurrent.futures
+import itertools
 import json
 import os
-import urllib
+import random
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
 
 import models
 
 API_KEY = os.environ.get('SOS_FORECAST_API_KEY')
+API_URL = os.environ.get('SOS_FORECAST_API_URL', 'https://api.forecast.io/forecast')
 
+# Requests in flight at once
+CONCURRENCY = int(os.environ.get('SOS_FORECAST_CONCURRENCY', 8))
+# Requests per second allowed by the API quota, and how many may be sent in a burst
+RATE = float(os.environ.get('SOS_FORECAST_RATE', 10))
+BURST = 10
 
-def main():
-	coordinates = models.Coordinate.select()
+# Seconds to wait for a response
+TIMEOUT = 30
+# Attempts per forecast, waiting BACKOFF, 2 * BACKOFF, 4 * BACKOFF... seconds in between
+ATTEMPTS = 5
+BACKOFF = 1.0
 
-	for point in coordinates:
-		url = 'https://api.forecast.io/forecast/' + API_KEY + '/' + \
-			str(point.latitude) + ',' + str(point.longitude)
-		response = urllib.request.urlopen(url)
-		encoding = response.info().get_content_charset('utf-8')
-		raw = response.read()
-		data = json.loads(raw.decode(encoding))
+# Points are grouped into square cells of GRID degrees (0.01 is about 1 km) and
+# share the forecast of the cell center, 0 fetches a forecast per point
+GRID = float(os.environ.get('SOS_FORECAST_GRID', 0.01))
+# Seconds between forecast issues, responses are reused within one
+ISSUE_INTERVAL = int(os.environ.get('SOS_FORECAST_ISSUE_INTERVAL', 3600))
 
-		day_summary = data['daily']['summary']
+# Number of days forecast, stored with lead_days 0 to 7
+FORECAST_DAYS = 8
 
-		ft_0_time = data['daily']['data'][0]['time']
-		ft_0_precip_int_max = data['daily']['data'][0]['precipIntensityMax']
-		try:
-			ft_0_precip_accum = data['daily']['data'][0]['precipAccumulation']
-		except KeyError:
-			ft_0_precip_accum = 0
-		ft_0_temp_min = data['daily']['data'][0]['temperatureMin']
-		ft_0_temp_max = data['daily']['data'][0]['temperatureMax']
-
-		ft_1_time = data['daily']['data'][1]['time']
-		ft_1_precip_int_max = data['daily']['data'][1]['precipIntensityMax']
-		try:
-			ft_1_precip_accum = data['daily']['data'][1]['precipAccumulation']
-		except KeyError:
-			ft_1_precip_accum = 0
-		ft_1_temp_min = data['daily']['data'][1]['temperatureMin']
-		ft_1_temp_max = data['daily']['data'][1]['temperatureMax']
-
-		ft_2_time = data['daily']['data'][2]['time']
-		ft_2_precip_int_max = data['daily']['data'][2]['precipIntensityMax']
-		try:
-			ft_2_precip_accum = data['daily']['data'][2]['precipAccumulation']
-		except KeyError:
-			ft_2_precip_accum = 0
-		ft_2_temp_min = data['daily']['data'][2]['temperatureMin']
-		ft_2_temp_max = data['daily']['data'][2]['temperatureMax']
-
-		ft_3_time = data['daily']['data'][3]['time']
-		ft_3_precip_int_max = data['daily']['data'][3]['precipIntensityMax']
-		try:
-			ft_3_precip_accum = data['daily']['data'][3]['precipAccumulation']
-		except KeyError:
-			ft_3_precip_accum = 0
-		ft_3_temp_min = data['daily']['data'][3]['temperatureMin']
-		ft_3_temp_max = data['daily']['data'][3]['temperatureMax']
-
-		ft_4_time = data['daily']['data'][4]['time']
-		ft_4_precip_int_max = data['daily']['data'][4]['precipIntensityMax']
-		try:
-			ft_4_precip_accum = data['daily']['data'][4]['precipAccumulation']
-		except KeyError:
-			ft_4_precip_accum = 0
-		ft_4_temp_min = data['daily']['data'][4]['temperatureMin']
-		ft_4_temp_max = data['daily']['data'][4]['temperatureMax']
-
-		ft_5_time = data['daily']['data'][5]['time']
-		ft_5_precip_int_max = data['daily']['data'][5]['precipIntensityMax']
-		try:
-			ft_5_precip_accum = data['daily']['data'][5]['precipAccumulation']
-		except KeyError:
-			ft_5_precip_accum = 0
-		ft_5_temp_min = data['daily']['data'][5]['temperatureMin']
-		ft_5_temp_max = data['daily']['data'][5]['temperatureMax']
-
-		ft_6_time = data['daily']['data'][6]['time']
-		ft_6_precip_int_max = data['daily']['data'][6]['precipIntensityMax']
-		try:
-			ft_6_precip_accum = data['daily']['data'][6]['precipAccumulation']
-		except KeyError:
-			ft_6_precip_accum = 0
-		ft_6_temp_min = data['daily']['data'][6]['temperatureMin']
-		ft_6_temp_max = data['daily']['data'][6]['temperatureMax']
-
-		ft_7_time = data['daily']['data'][7]['time']
-		ft_7_precip_int_max = data['daily']['data'][7]['precipIntensityMax']
+# Forecast rows written per transaction, small enough not to keep the web workers waiting for the lock
+WRITE_BATCH = 1000
+
+
+class TokenBucket(object):
+	"""Thread safe token bucket allowing `rate` acquisitions per second after an initial burst of `capacity`."""
+
+	def __init__(self, rate, capacity=1):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		"""Take a token, waiting as long as it takes for one to be added."""
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+
+class RetryableError(Exception):
+	"""A request failed in a way that is worth trying again, after `delay` seconds if given."""
+
+	def __init__(self, message, delay=None):
+		super(RetryableError, self).__init__(message)
+		self.delay = delay
+
+
+def forecast_url(latitude, longitude):
+	return '{}/{}/{},{}'.format(API_URL.rstrip('/'), API_KEY, latitude, longitude)
+
+
+def request_forecast(url):
+	"""Fetch and decode a forecast, raising RetryableError for timeouts, throttling and server errors."""
+	try:
+		with urllib.request.urlopen(url, timeout=TIMEOUT) as response:
+			encoding = response.info().get_content_charset('utf-8')
+			return json.loads(response.read().decode(encoding))
+	except urllib.error.HTTPError as e:
+		if e.code == 429 or e.code >= 500:
+			retry_after = e.headers.get('Retry-After', '')
+			raise RetryableError('HTTP {}'.format(e.code), float(retry_after) if retry_after.isdigit() else None)
+		raise
+	except (urllib.error.URLError, socket.timeout, ConnectionError) as e:
+		raise RetryableError(str(e))
+
+
+def fetch_forecast(latitude, longitude, bucket):
+	"""Fetch the forecast for a position, retrying with exponential backoff and jitter."""
+	url = forecast_url(latitude, longitude)
+	for attempt in range(ATTEMPTS):
+		bucket.acquire()
 		try:
-			ft_7_precip_accum = data['daily']['data'][7]['precipAccumulation']
-		except KeyError:
-			ft_7_precip_accum = 0
-		ft_7_temp_min = data['daily']['data'][7]['temperatureMin']
-		ft_7_temp_max = data['daily']['data'][7]['temperatureMax']
-
-		weather_event = models.Weather.create(
-			coordinate = point,
-			day_summary = day_summary,
-
-			ft_0_time = ft_0_time,
-			ft_0_precip_intensity_max = ft_0_precip_int_max,
-			ft_0_precip_accumulation = ft_0_precip_accum,
-			ft_0_temp_min = ft_0_temp_min,
-			ft_0_temp_max = ft_0_temp_max,
-
-			ft_1_time = ft_1_time,
-			ft_1_precip_intensity_max = ft_1_precip_int_max,
-			ft_1_precip_accumulation = ft_1_precip_accum,
-			ft_1_temp_min = ft_1_temp_min,
-			ft_1_temp_max = ft_1_temp_max,
-
-			ft_2_time = ft_2_time,
-			ft_2_precip_intensity_max = ft_2_precip_int_max,
-			ft_2_precip_accumulation = ft_2_precip_accum,
-			ft_2_temp_min = ft_2_temp_min,
-			ft_2_temp_max = ft_2_temp_max,
-
-			ft_3_time = ft_3_time,
-			ft_3_precip_intensity_max = ft_3_precip_int_max,
-			ft_3_precip_accumulation = ft_3_precip_accum,
-			ft_3_temp_min = ft_3_temp_min,
-			ft_3_temp_max = ft_3_temp_max,
-
-			ft_4_time = ft_4_time,
-			ft_4_precip_intensity_max = ft_4_precip_int_max,
-			ft_4_precip_accumulation = ft_4_precip_accum,
-			ft_4_temp_min = ft_4_temp_min,
-			ft_4_temp_max = ft_4_temp_max,
-
-			ft_5_time = ft_5_time,
-			ft_5_precip_intensity_max = ft_5_precip_int_max,
-			ft_5_precip_accumulation = ft_5_precip_accum,
-			ft_5_temp_min = ft_5_temp_min,
-			ft_5_temp_max = ft_5_temp_max,
-
-			ft_6_time = ft_6_time,
-			ft_6_precip_intensity_max = ft_6_precip_int_max,
-			ft_6_precip_accumulation = ft_6_precip_accum,
-			ft_6_temp_min = ft_6_temp_min,
-			ft_6_temp_max = ft_6_temp_max,
-
-			ft_7_time = ft_7_time,
-			ft_7_precip_intensity_max = ft_7_precip_int_max,
-			ft_7_precip_accumulation = ft_7_precip_accum,
-			ft_7_temp_min = ft_7_temp_min,
-			ft_7_temp_max = ft_7_temp_max,
-		)
+			return request_forecast(url)
+		except RetryableError as e:
+			if attempt == ATTEMPTS - 1:
+				raise
+			time.sleep(e.delay or BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def grid_cell(latitude, longitude, grid=GRID):
+	"""Center of the grid cell containing a position, the position itself without a grid."""
+	if not grid:
+		return latitude, longitude
+	return round(round(latitude / grid) * grid, 6), round(round(longitude / grid) * grid, 6)
+
+
+def group_by_cell(points, grid=GRID):
+	"""{(latitude, longitude) of a cell: [point ids]} for (id, latitude, longitude) tuples."""
+	cells = collections.defaultdict(list)
+	for point_id, latitude, longitude in points:
+		cells[grid_cell(latitude, longitude, grid)].append(point_id)
+	return cells
+
+
+def issue_time(now=None, interval=ISSUE_INTERVAL):
+	"""Start of the forecast issue period `now` falls in, as Unix time."""
+	now = time.time() if now is None else now
+	return int(now // interval * interval)
+
+
+def parse_forecast(data):
+	"""WeatherDay values after the coordinate, from valid_date to tmax, for each day of a forecast response."""
+	days = []
+	for lead_days, forecast in enumerate(data['daily']['data'][:FORECAST_DAYS]):
+		days.append((
+			models.WeatherDay.day_of(forecast['time']).isoformat(),
+			lead_days,
+			models.WeatherDay.FORECAST,
+			data['daily']['summary'] if lead_days == 0 else None,
+			forecast['precipIntensityMax'],
+			forecast.get('precipAccumulation', 0),
+			forecast['temperatureMin'],
+			forecast['temperatureMax'],
+		))
+	return days
+
+
+def fetch_forecasts(points, concurrency=CONCURRENCY, rate=RATE):
+	"""Yield (key, decoded response or the exception raised) for (key, latitude, longitude) tuples.
+
+	Forecasts are yielded as they complete, not in the order of `points`. Only
+	a few requests per worker are queued at a time however many points there are.
+	"""
+	points = iter(points)
+	bucket = TokenBucket(rate, min(BURST, concurrency))
+	with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+		pending = {}
+		while True:
+			for key, latitude, longitude in itertools.islice(points, concurrency * 2 - len(pending)):
+				pending[executor.submit(fetch_forecast, latitude, longitude, bucket)] = key
+			if not pending:
+				return
+			done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				key = pending.pop(future)
+				try:
+					yield key, future.result()
+				except Exception as e:
+					yield key, e
+
+
+def forecast_rows(point_ids, data):
+	"""WeatherDay rows of a forecast for every point of a cell."""
+	days = parse_forecast(data)
+	return [(point_id,) + day for point_id in point_ids for day in days]
+
+
+def save_forecasts(rows, responses, issued):
+	"""Upsert WeatherDay rows and cache the cell responses, all in one transaction.
+
+	Rows replace any forecast stored for the same point, day and lead time,
+	so a rerun doesn't add duplicates.
+	"""
+	with models.WeatherDay._meta.database.atomic():
+		models.CellForecast.store(responses, issued)
+		models.WeatherDay.upsert(rows)
+
+
+class ForecastWriter(object):
+	"""Collects the weather rows of fetched forecasts and saves them WRITE_BATCH rows at a time."""
+
+	def __init__(self, issued, batch=WRITE_BATCH):
+		self.issued = issued
+		self.batch = batch
+		self.rows = []
+		self.responses = []
+		self.written = 0
+		self.seconds = 0.0
+
+	def add(self, cell, point_ids, data, cache=True):
+		"""Queue the forecast of a cell for its points, and the response for the cache unless it came from there."""
+		self.rows.extend(forecast_rows(point_ids, data))
+		if cache:
+			self.responses.append((cell, data))
+		if len(self.rows) >= self.batch:
+			self.flush()
+
+	def flush(self):
+		if not self.rows and not self.responses:
+			return
+		started = time.monotonic()
+		save_forecasts(self.rows, self.responses, self.issued)
+		self.seconds += time.monotonic() - started
+		self.written += len(self.rows)
+		self.rows = []
+		self.responses = []
+
+	def rate(self):
+		"""Rows written per second spent writing."""
+		return self.written / self.seconds if self.seconds else 0.0
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='requests in flight at once')
+	parser.add_argument('--rate', type=float, default=RATE, help='requests per second')
+	parser.add_argument('--grid', type=float, default=GRID, help='size of the grid cells in degrees, 0 for none')
+	args = parser.parse_args()
+	if not API_KEY:
+		parser.error('SOS_FORECAST_API_KEY is not set')
+
+	models.initialize()
+	issued = issue_time()
+	cells = group_by_cell(models.Coordinate
+						  .select(models.Coordinate.id, models.Coordinate.latitude, models.Coordinate.longitude)
+						  .tuples()
+						  .iterator(), args.grid)
+	cached = models.CellForecast.cached(issued)
+	missing = [(cell,) + cell for cell in cells if cell not in cached]
+
+	failed = 0
+	writer = ForecastWriter(issued)
+	results = itertools.chain(
+		((cell, data) for cell, data in cached.items() if cell in cells),
+		fetch_forecasts(missing, args.concurrency, args.rate))
+	for cell, result in results:
+		if not isinstance(result, Exception):
+			try:
+				writer.add(cell, cells[cell], result, cache=cell not in cached)
+				continue
+			except (KeyError, TypeError) as e:
+				result = e
+		failed += len(cells[cell])
+		print('Forecast for {},{} ({} point(s)) failed: {}'.format(cell[0], cell[1], len(cells[cell]), result))
+	writer.flush()
+	models.CellForecast.prune(issued)
+
+	print('{} point(s) in {} cell(s), {} forecast(s) fetched, {} reused.'.format(
+		sum(len(point_ids) for point_ids in cells.values()), len(cells), len(missing), len(cells) - len(missing)))
+	print('{} row(s) written in {:.2f}s ({:.0f} rows/s).'.format(writer.written, writer.seconds, writer.rate()))
+	if failed:
+		print('{} point(s) got no forecast.'.format(failed))
 
 
 if __name__ == '__main__':